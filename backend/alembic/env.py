@@ -9,13 +9,16 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 # Importa os modelos para que o Alembic possa detectá-los
-from main import Base
+from main import Base, SQLALCHEMY_DATABASE_URL
 target_metadata = Base.metadata
 
 # Configuração do Alembic
 config = context.config
 fileConfig(config.config_file_name)
 
+# Usa o mesmo banco da aplicação (variável DATABASE_URL)
+config.set_main_option("sqlalchemy.url", SQLALCHEMY_DATABASE_URL)
+
 def run_migrations_offline():
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
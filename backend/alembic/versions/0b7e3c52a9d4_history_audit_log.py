@@ -0,0 +1,46 @@
+"""History audit log: action_month and indexes
+
+Revision ID: 0b7e3c52a9d4
+Revises: f2a86d4c9b13
+Create Date: 2026-10-18 14:22:08.416930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = '0b7e3c52a9d4'
+down_revision = 'f2a86d4c9b13'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_products_history_owner_original_date', ['owner', 'original_id', 'action_date']),
+    ('ix_products_history_action_month', ['action_month']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    # main.init_db() (importado pelo env.py) já pode ter criado a coluna e os índices
+    if 'action_month' not in {column['name'] for column in inspector.get_columns('products_history')}:
+        op.add_column('products_history', sa.Column('action_month', sa.String(), nullable=True))
+
+    op.execute(
+        "UPDATE products_history SET action_month = substr(action_date, 1, 7) "
+        "WHERE action_month IS NULL"
+    )
+
+    existing = {index['name'] for index in inspector.get_indexes('products_history')}
+    for name, columns in INDEXES:
+        if name not in existing:
+            op.create_index(name, 'products_history', columns)
+
+
+def downgrade():
+    for name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name='products_history')
+    with op.batch_alter_table('products_history') as batch_op:
+        batch_op.drop_column('action_month')
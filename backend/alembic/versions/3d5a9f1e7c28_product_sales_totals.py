@@ -0,0 +1,66 @@
+"""Product sales totals (top-products leaderboard)
+
+Revision ID: 3d5a9f1e7c28
+Revises: 0b7e3c52a9d4
+Create Date: 2026-10-18 15:10:37.902514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = '3d5a9f1e7c28'
+down_revision = '0b7e3c52a9d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # main.init_db() (importado pelo env.py) já pode ter criado e preenchido a tabela
+    if 'product_sales_totals' in sa.inspect(bind).get_table_names():
+        return
+
+    op.create_table(
+        'product_sales_totals',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('owner', sa.String(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.Column('quantity', sa.Integer(), nullable=True),
+        sa.Column('revenue_brl', sa.Float(), nullable=True),
+        sa.Column('revenue_usd', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('owner', 'product_id', name='uq_product_sales_totals_owner_product')
+    )
+    op.create_index('ix_product_sales_totals_id', 'product_sales_totals', ['id'])
+    op.create_index('ix_product_sales_totals_owner_quantity', 'product_sales_totals', ['owner', 'quantity', 'product_id'])
+    op.create_index('ix_product_sales_totals_owner_revenue', 'product_sales_totals', ['owner', 'revenue_brl', 'product_id'])
+
+    # Backfill a partir das vendas; produtos removidos levam a última descrição do histórico
+    op.execute("""
+        INSERT INTO product_sales_totals (owner, product_id, description, quantity, revenue_brl, revenue_usd)
+        SELECT
+            s.owner,
+            s.product_id,
+            COALESCE(
+                (SELECT p.description FROM products p WHERE p.id = s.product_id),
+                (SELECT h.description FROM products_history h
+                 WHERE h.owner = s.owner AND h.original_id = s.product_id
+                 ORDER BY h.id DESC LIMIT 1)
+            ),
+            SUM(s.quantity),
+            SUM(s.sale_value_brl),
+            SUM(s.sale_value_usd)
+        FROM sales s
+        GROUP BY s.owner, s.product_id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_product_sales_totals_owner_revenue', table_name='product_sales_totals')
+    op.drop_index('ix_product_sales_totals_owner_quantity', table_name='product_sales_totals')
+    op.drop_index('ix_product_sales_totals_id', table_name='product_sales_totals')
+    op.drop_table('product_sales_totals')
@@ -0,0 +1,53 @@
+"""Sales daily rollup
+
+Revision ID: 5c1e7a2d9f40
+Revises: b34f0d9e39ff
+Create Date: 2026-10-18 09:12:41.512310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = '5c1e7a2d9f40'
+down_revision = 'b34f0d9e39ff'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # main.init_db() (importado pelo env.py) já pode ter criado a tabela
+    if 'sales_daily' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'sales_daily',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('owner', sa.String(), nullable=False),
+        sa.Column('day', sa.String(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('categories', sa.String(), nullable=True),
+        sa.Column('quantity', sa.Integer(), nullable=True),
+        sa.Column('revenue_brl', sa.Float(), nullable=True),
+        sa.Column('revenue_usd', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('owner', 'day', 'product_id', name='uq_sales_daily_owner_day_product')
+    )
+    op.create_index('ix_sales_daily_id', 'sales_daily', ['id'])
+    op.create_index('ix_sales_daily_owner_day', 'sales_daily', ['owner', 'day'])
+
+    # Backfill a partir das vendas já registradas
+    op.execute("""
+        INSERT INTO sales_daily (owner, day, product_id, categories, quantity, revenue_brl, revenue_usd)
+        SELECT s.owner, substr(s.sale_date, 1, 10), s.product_id, max(p.categories),
+               sum(s.quantity), sum(s.sale_value_brl), sum(s.sale_value_usd)
+        FROM sales s LEFT OUTER JOIN products p ON p.id = s.product_id
+        GROUP BY s.owner, substr(s.sale_date, 1, 10), s.product_id
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_sales_daily_owner_day', table_name='sales_daily')
+    op.drop_index('ix_sales_daily_id', table_name='sales_daily')
+    op.drop_table('sales_daily')
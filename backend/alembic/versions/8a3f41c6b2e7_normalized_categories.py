@@ -0,0 +1,71 @@
+"""Normalized categories
+
+Revision ID: 8a3f41c6b2e7
+Revises: 5c1e7a2d9f40
+Create Date: 2026-10-18 10:02:17.903114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = '8a3f41c6b2e7'
+down_revision = '5c1e7a2d9f40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    tables = sa.inspect(bind).get_table_names()
+
+    # main.init_db() (importado pelo env.py) já pode ter criado as tabelas
+    if 'categories' not in tables:
+        op.create_table(
+            'categories',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('name')
+        )
+        op.create_index('ix_categories_id', 'categories', ['id'])
+
+    if 'product_categories' not in tables:
+        op.create_table(
+            'product_categories',
+            sa.Column('product_id', sa.Integer(), nullable=False),
+            sa.Column('category_id', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('product_id', 'category_id')
+        )
+        op.create_index('ix_product_categories_category_product', 'product_categories', ['category_id', 'product_id'])
+
+    # Migra as strings separadas por vírgula de products.categories
+    if bind.execute(sa.text("SELECT 1 FROM product_categories LIMIT 1")).first() is not None:
+        return
+
+    rows = bind.execute(sa.text("SELECT id, categories FROM products")).fetchall()
+    links = []
+    names = set()
+    for product_id, categories in rows:
+        for name in {c.strip() for c in (categories or "").split(",") if c.strip()}:
+            names.add(name)
+            links.append((product_id, name))
+
+    existing = {name for name, in bind.execute(sa.text("SELECT name FROM categories"))}
+    for name in sorted(names - existing):
+        bind.execute(sa.text("INSERT INTO categories (name) VALUES (:name)"), {"name": name})
+
+    category_ids = dict(bind.execute(sa.text("SELECT name, id FROM categories")).fetchall())
+    if links:
+        bind.execute(
+            sa.text("INSERT INTO product_categories (product_id, category_id) VALUES (:product_id, :category_id)"),
+            [{"product_id": product_id, "category_id": category_ids[name]} for product_id, name in links]
+        )
+
+
+def downgrade():
+    op.drop_index('ix_product_categories_category_product', table_name='product_categories')
+    op.drop_table('product_categories')
+    op.drop_index('ix_categories_id', table_name='categories')
+    op.drop_table('categories')
@@ -0,0 +1,68 @@
+"""Product soft delete and stock state (replaces dashboard_products)
+
+Revision ID: 9c41e6d2f8b7
+Revises: 3d5a9f1e7c28
+Create Date: 2026-10-18 16:02:51.337104
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from main import backfill_product_state
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = '9c41e6d2f8b7'
+down_revision = '3d5a9f1e7c28'
+branch_labels = None
+depends_on = None
+
+PRODUCT_NOT_DELETED = "deleted_at IS NULL"
+PRODUCT_AVAILABLE = "deleted_at IS NULL AND quantity > 0"
+
+COLUMNS = [
+    sa.Column('sold_quantity', sa.Integer(), nullable=True),
+    sa.Column('last_update', sa.String(), nullable=True),
+    sa.Column('deleted_at', sa.String(), nullable=True),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    # main.init_db() (importado pelo env.py) já pode ter criado as colunas e os índices
+    existing_columns = {column['name'] for column in inspector.get_columns('products')}
+    for column in COLUMNS:
+        if column.name not in existing_columns:
+            op.add_column('products', column)
+
+    existing_indexes = {index['name'] for index in inspector.get_indexes('products')}
+    if 'ix_products_owner_id' in existing_indexes:
+        op.drop_index('ix_products_owner_id', table_name='products')
+    if 'ix_products_available_owner_id' not in existing_indexes:
+        op.create_index(
+            'ix_products_available_owner_id', 'products', ['owner', 'id'],
+            sqlite_where=sa.text(PRODUCT_AVAILABLE), postgresql_where=sa.text(PRODUCT_AVAILABLE)
+        )
+    if 'ix_products_owner_last_update' not in existing_indexes:
+        op.create_index(
+            'ix_products_owner_last_update', 'products', ['owner', 'last_update', 'id'],
+            sqlite_where=sa.text(PRODUCT_NOT_DELETED), postgresql_where=sa.text(PRODUCT_NOT_DELETED)
+        )
+
+    # Vendidos e última atualização vinham de dashboard_products; mesma rotina do init_db
+    backfill_product_state(Session(bind=bind))
+
+
+def downgrade():
+    existing_indexes = {index['name'] for index in sa.inspect(op.get_bind()).get_indexes('products')}
+    for name in ('ix_products_owner_last_update', 'ix_products_available_owner_id'):
+        if name in existing_indexes:
+            op.drop_index(name, table_name='products')
+    if 'ix_products_owner_id' not in existing_indexes:
+        op.create_index('ix_products_owner_id', 'products', ['owner', 'id'])
+    with op.batch_alter_table('products') as batch_op:
+        for column in reversed(COLUMNS):
+            batch_op.drop_column(column.name)
@@ -0,0 +1,43 @@
+"""Keyset pagination indexes
+
+Revision ID: c4d92e7b1a05
+Revises: 8a3f41c6b2e7
+Create Date: 2026-10-18 10:47:55.218640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = 'c4d92e7b1a05'
+down_revision = '8a3f41c6b2e7'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_products_owner_id', 'products', ['owner', 'id']),
+    ('ix_sales_owner_sale_date', 'sales', ['owner', 'sale_date', 'id']),
+    ('ix_products_history_owner_action_date', 'products_history', ['owner', 'action_date', 'id']),
+    ('ix_dashboard_products_owner_last_update', 'dashboard_products', ['owner', 'last_update', 'id']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for name, table, columns in INDEXES:
+        # dashboard_products não é mais criada pelo main.init_db() (ver 9c41e6d2f8b7)
+        if table not in tables:
+            continue
+        # main.init_db() (importado pelo env.py) já pode ter criado o índice
+        if name not in {index['name'] for index in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    for name, table, _ in reversed(INDEXES):
+        if table in tables and name in {index['name'] for index in inspector.get_indexes(table)}:
+            op.drop_index(name, table_name=table)
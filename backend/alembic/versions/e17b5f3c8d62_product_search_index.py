@@ -0,0 +1,62 @@
+"""Product search index
+
+Revision ID: e17b5f3c8d62
+Revises: c4d92e7b1a05
+Create Date: 2026-10-18 11:25:09.741882
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = 'e17b5f3c8d62'
+down_revision = 'c4d92e7b1a05'
+branch_labels = None
+depends_on = None
+
+TRIGGERS = ['products_fts_ai', 'products_fts_ad', 'products_fts_au']
+
+
+def upgrade():
+    # Índice FTS5 só existe no SQLite; em outros bancos a busca usa ILIKE
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+
+    exists = bind.execute(sa.text("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")).first()
+    op.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            description,
+            content='products',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4'
+        )
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF description ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, description) VALUES ('delete', old.id, old.description);
+            INSERT INTO products_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """)
+    if not exists:
+        op.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for trigger in TRIGGERS:
+        op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    op.execute("DROP TABLE IF EXISTS products_fts")
@@ -0,0 +1,43 @@
+"""Users table
+
+Revision ID: f2a86d4c9b13
+Revises: e17b5f3c8d62
+Create Date: 2026-10-18 13:05:41.582307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# Identificadores de revisão usados pelo Alembic.
+revision = 'f2a86d4c9b13'
+down_revision = 'e17b5f3c8d62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # main.init_db() (importado pelo env.py) já pode ter criado a tabela;
+    # os usuários iniciais são gravados pelo init_db
+    if 'users' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(), nullable=False),
+        sa.Column('email', sa.String(), nullable=True),
+        sa.Column('hashed_password', sa.String(), nullable=False),
+        sa.Column('disabled', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_users_id', 'users', ['id'])
+    op.create_index('ix_users_username', 'users', ['username'], unique=True)
+    op.create_index('ix_users_email', 'users', ['email'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_users_email', table_name='users')
+    op.drop_index('ix_users_username', table_name='users')
+    op.drop_index('ix_users_id', table_name='users')
+    op.drop_table('users')
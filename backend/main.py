@@ -20,43 +20,140 @@
 
 # ===================== IMPORTS E CONFIGS IMPORTANTES =====================
 
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect, Response, UploadFile, File
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
-from pydantic import BaseModel
-from datetime import datetime, timedelta
+from pydantic import BaseModel, Field, ValidationError
+from datetime import datetime, timedelta, date
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from typing import Optional, List
-import requests
 from enum import Enum
 from fastapi import Query
-from sqlalchemy import create_engine, Column, Integer, String, Float, Enum as SQLEnum, func
+from sqlalchemy import create_engine, Column, Integer, String, Float, Enum as SQLEnum, Date, func, select, insert, update, delete, or_, tuple_, cast, case, Numeric
+from sqlalchemy import UniqueConstraint, Index, text, table, literal_column, event, inspect, and_
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.exc import IntegrityError
 import redis
-from functools import wraps
+import redis.asyncio
+from redis.exceptions import RedisError
+from fastapi.encoders import jsonable_encoder
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor
 import os
-import pickle
+import sys
+import argparse
+import re
+import json
+import csv
+import io
+import base64
+import hashlib
+import asyncio
+import threading
+import random
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from types import SimpleNamespace
+import httpx
 
 # Configurações
 SECRET_KEY = "SECRET_123"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 CACHE_EXPIRE_SECONDS = 300  
+REPRICE_CHUNK_SIZE = int(os.getenv("REPRICE_CHUNK_SIZE", 50000))
+# Histórico de produtos: eventos acumulados na sessão e gravados em lote
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", 1))
+HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", 0))  # 0: guarda tudo
+CHECKOUT_MAX_ITEMS = int(os.getenv("CHECKOUT_MAX_ITEMS", 200))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", 1000))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", 1000))  # erros listados na resposta; os demais só contam
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+ANALYTICS_MAX_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUCKETS", 3660))
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# Configuração do banco de dados
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sql_app.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+# Threads que executam as consultas fora do event loop. Consultas analíticas têm
+# um pool próprio para não ocupar os workers usados por compras e CRUD.
+DB_WORKERS = int(os.getenv("DB_WORKERS", DB_POOL_SIZE))
+ANALYTICS_WORKERS = int(os.getenv("ANALYTICS_WORKERS", 4))
 
 # Configuração do Redis
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_RETRY_SECONDS = float(os.getenv("REDIS_RETRY_SECONDS", 30))
+
+# Cache local (por processo) na frente do Redis
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", 2048))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+LOCAL_CACHE_TTL_SECONDS = float(os.getenv("LOCAL_CACHE_TTL_SECONDS", 30))
+
+# Cache de autenticação: tokens já verificados (até o `exp`) e usuários resolvidos
+AUTH_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_TOKEN_CACHE_MAX_ENTRIES", 10000))
+AUTH_PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_PRINCIPAL_CACHE_MAX_ENTRIES", 10000))
+AUTH_PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("AUTH_PRINCIPAL_CACHE_TTL_SECONDS", 60))
+
+# Verificação de senha (bcrypt) em pool próprio, com fila limitada
+PASSWORD_BCRYPT_ROUNDS = int(os.getenv("PASSWORD_BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 4))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", 32))
+PASSWORD_TIMEOUT_SECONDS = float(os.getenv("PASSWORD_TIMEOUT_SECONDS", 5))
+
+# WebSockets do dashboard: fila de envio por conexão e detecção de clientes mortos
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", 10))
+WS_PING_INTERVAL_SECONDS = float(os.getenv("WS_PING_INTERVAL_SECONDS", 20))
+WS_PING_TIMEOUT_SECONDS = float(os.getenv("WS_PING_TIMEOUT_SECONDS", 60))
+# Protocolo 2 do dashboard: snapshot inicial + deltas numerados por dono
+DASHBOARD_PROTOCOL_VERSION = 2
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", 1000))
+WS_SNAPSHOT_CHUNK_SIZE = int(os.getenv("WS_SNAPSHOT_CHUNK_SIZE", 1000))
+# Vendas do mesmo dono são agrupadas numa janela curta antes de ir aos dashboards
+# (0 desliga o agrupamento)
+SALE_BATCH_WINDOW_SECONDS = float(os.getenv("SALE_BATCH_WINDOW_SECONDS", 0.15))
+SALE_BATCH_MAX_EVENTS = int(os.getenv("SALE_BATCH_MAX_EVENTS", 200))
+
+# Identifica este worker nas mensagens de pub/sub
+WORKER_ID = uuid.uuid4().hex
+
+# Inicializa o Redis (cliente assíncrono: nunca bloqueia o event loop)
+redis_client = redis.asyncio.Redis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    decode_responses=True,
+    socket_timeout=1,
+    socket_connect_timeout=1
+)
 
-# Inicializa o Redis
-redis_client = redis.Redis(
+# Conexões de pub/sub ficam ociosas esperando mensagens: sem timeout de leitura,
+# com health check para detectar quedas
+redis_pubsub_client = redis.asyncio.Redis(
     host=REDIS_HOST,
     port=REDIS_PORT,
     db=REDIS_DB,
-    decode_responses=False
+    decode_responses=True,
+    socket_connect_timeout=1,
+    health_check_interval=30
 )
 
 
@@ -69,27 +166,33 @@ class Status(str, Enum):
     yellow = "yellow"
     green = "green"
 
-class DashboardProduct(Base):
-    __tablename__ = "dashboard_products"
-    
-    id = Column(Integer, primary_key=True, index=True)
-    original_id = Column(Integer, index=True)  
-    description = Column(String)
-    image_url = Column(String)
-    initial_quantity = Column(Integer)  
-    sold_quantity = Column(Integer, default=0)  
-    current_quantity = Column(Integer) 
-    suggested_quantity = Column(Integer)
-    price_brl = Column(Float)
-    price_usd = Column(Float)
-    status = Column(SQLEnum(Status))
-    categories = Column(String)
-    owner = Column(String)
-    last_update = Column(String, default=datetime.utcnow().isoformat())
-    is_active = Column(Integer, default=1)  
+class AnalyticsPeriod(str, Enum):
+    day = "day"
+    week = "week"
+    month = "month"
+    year = "year"
+
+class AnalyticsBreakdown(str, Enum):
+    category = "category"
+    product = "product"
+
+class DataFormat(str, Enum):
+    csv = "csv"
+    ndjson = "ndjson"
+
+class LeaderboardMetric(str, Enum):
+    quantity = "quantity"
+    revenue = "revenue"
 
 class ProductHistory(Base):
+    # Log de auditoria, só com inserções; action_month ("AAAA-MM") permite
+    # apagar (ou particionar) por mês
     __tablename__ = "products_history"
+    __table_args__ = (
+        Index("ix_products_history_owner_action_date", "owner", "action_date", "id"),
+        Index("ix_products_history_owner_original_date", "owner", "original_id", "action_date"),
+        Index("ix_products_history_action_month", "action_month"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     original_id = Column(Integer, index=True)  
@@ -103,11 +206,29 @@ class ProductHistory(Base):
     categories = Column(String)
     owner = Column(String)
     action = Column(String) 
-    action_date = Column(String, default=datetime.utcnow().isoformat())
+    action_date = Column(String, default=lambda: datetime.utcnow().isoformat())
     action_reason = Column(String, nullable=True)  
+    action_month = Column(String, nullable=True)
+
+# Condições dos índices parciais de produtos; as consultas usam os mesmos
+# termos (ver product_available) para o banco poder usá-los
+PRODUCT_NOT_DELETED = "deleted_at IS NULL"
+PRODUCT_AVAILABLE = "deleted_at IS NULL AND quantity > 0"
 
 class Product(Base):
+    # Produtos esgotados (quantity = 0) e excluídos (deleted_at preenchido)
+    # continuam na tabela, para as vendas seguirem ligadas a eles
     __tablename__ = "products"
+    __table_args__ = (
+        Index(
+            "ix_products_available_owner_id", "owner", "id",
+            sqlite_where=text(PRODUCT_AVAILABLE), postgresql_where=text(PRODUCT_AVAILABLE)
+        ),
+        Index(
+            "ix_products_owner_last_update", "owner", "last_update", "id",
+            sqlite_where=text(PRODUCT_NOT_DELETED), postgresql_where=text(PRODUCT_NOT_DELETED)
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     description = Column(String)
@@ -119,9 +240,15 @@ class Product(Base):
     status = Column(SQLEnum(Status))
     categories = Column(String)
     owner = Column(String)
+    sold_quantity = Column(Integer, default=0)
+    last_update = Column(String, default=lambda: datetime.utcnow().isoformat())
+    deleted_at = Column(String, nullable=True)
 
 class Sale(Base):
     __tablename__ = "sales"
+    __table_args__ = (
+        Index("ix_sales_owner_sale_date", "owner", "sale_date", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     product_id = Column(Integer, index=True)
@@ -131,6 +258,68 @@ class Sale(Base):
     sale_value_usd = Column(Float)
     owner = Column(String)
 
+class UserAccount(Base):
+    # Usuários persistidos; o modelo Pydantic `User` é a visão pública
+    __tablename__ = "users"
+
+    id = Column(Integer, primary_key=True, index=True)
+    username = Column(String, nullable=False, unique=True, index=True)
+    email = Column(String, nullable=True, unique=True, index=True)
+    hashed_password = Column(String, nullable=False)
+    disabled = Column(Integer, default=0)
+
+class Category(Base):
+    __tablename__ = "categories"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False, unique=True)
+
+class ProductCategory(Base):
+    # Associação produto–categoria; a PK cobre a busca por produto e o índice
+    # (category_id, product_id) cobre os filtros e agregações por categoria
+    __tablename__ = "product_categories"
+    __table_args__ = (
+        Index("ix_product_categories_category_product", "category_id", "product_id"),
+    )
+
+    product_id = Column(Integer, primary_key=True)
+    category_id = Column(Integer, primary_key=True)
+
+class SalesDaily(Base):
+    # Rollup diário de vendas por produto, mantido pelo fluxo de compra
+    __tablename__ = "sales_daily"
+    __table_args__ = (
+        UniqueConstraint("owner", "day", "product_id", name="uq_sales_daily_owner_day_product"),
+        Index("ix_sales_daily_owner_day", "owner", "day"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner = Column(String, nullable=False)
+    day = Column(String, nullable=False)  # YYYY-MM-DD
+    product_id = Column(Integer, nullable=False)
+    categories = Column(String)
+    quantity = Column(Integer, default=0)
+    revenue_brl = Column(Float, default=0)
+    revenue_usd = Column(Float, default=0)
+
+class ProductSalesTotal(Base):
+    # Placar de vendas por produto, mantido pelo fluxo de compra. A descrição
+    # fica aqui para o produto continuar no placar depois de removido.
+    __tablename__ = "product_sales_totals"
+    __table_args__ = (
+        UniqueConstraint("owner", "product_id", name="uq_product_sales_totals_owner_product"),
+        Index("ix_product_sales_totals_owner_quantity", "owner", "quantity", "product_id"),
+        Index("ix_product_sales_totals_owner_revenue", "owner", "revenue_brl", "product_id"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner = Column(String, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    description = Column(String)
+    quantity = Column(Integer, default=0)
+    revenue_brl = Column(Float, default=0)
+    revenue_usd = Column(Float, default=0)
+
 # ===================== PYDANTIC MODELOS =====================
 
 class Token(BaseModel):
@@ -148,6 +337,11 @@ class User(BaseModel):
 class UserInDB(User):
     hashed_password: str
 
+class UserCreate(BaseModel):
+    username: str = Field(..., min_length=3, max_length=255)
+    email: Optional[str] = Field(None, max_length=255)
+    password: str = Field(..., min_length=6, max_length=72)
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -174,7 +368,10 @@ class ProductResponse(ProductBase):
 
 class PurchaseRequest(BaseModel):
     product_id: int
-    quantity: int
+    quantity: int = Field(..., gt=0)
+
+class CheckoutRequest(BaseModel):
+    items: List[PurchaseRequest] = Field(..., min_length=1, max_length=CHECKOUT_MAX_ITEMS)
 
 class SaleResponse(BaseModel):
     id: int
@@ -189,12 +386,883 @@ class SaleResponse(BaseModel):
         from_attributes = True
 
 
+# ===================== CÂMBIO =====================
 
-# ===================== INICIALIZAÇÃO =====================
+EXCHANGE_RATE_URL = os.getenv("EXCHANGE_RATE_URL", "https://economia.awesomeapi.com.br/json/last/USD-BRL")
+EXCHANGE_RATE_TIMEOUT_SECONDS = float(os.getenv("EXCHANGE_RATE_TIMEOUT_SECONDS", 3))
+EXCHANGE_RATE_REFRESH_SECONDS = float(os.getenv("EXCHANGE_RATE_REFRESH_SECONDS", 300))
+EXCHANGE_RATE_RETRY_SECONDS = float(os.getenv("EXCHANGE_RATE_RETRY_SECONDS", 5))
+EXCHANGE_RATE_MAX_BACKOFF_SECONDS = float(os.getenv("EXCHANGE_RATE_MAX_BACKOFF_SECONDS", 1800))
+EXCHANGE_RATE_MIN_CHANGE = float(os.getenv("EXCHANGE_RATE_MIN_CHANGE", 0.001))  # variação relativa que repreça o catálogo
+DEFAULT_DOLLAR_RATE = 5.0
+
+class AwesomeApiRateProvider:
+    # Provedor padrão. Qualquer objeto com `async fetch(client) -> float` pode substituí-lo
+    # (ex.: um servidor local de stub nos testes, apontando EXCHANGE_RATE_URL para ele).
+    def __init__(self, url: str = EXCHANGE_RATE_URL):
+        self.url = url
+
+    async def fetch(self, client: httpx.AsyncClient) -> float:
+        response = await client.get(self.url)
+        response.raise_for_status()
+        data = response.json()
+        return float(data["USDBRL"]["bid"])
+
+@dataclass(frozen=True)
+class RateSnapshot:
+    rate: float
+    updated_at: Optional[datetime]  # None enquanto só existir o valor padrão
+    source: str
+
+    @property
+    def age_seconds(self) -> Optional[float]:
+        if self.updated_at is None:
+            return None
+        return (datetime.utcnow() - self.updated_at).total_seconds()
+
+class ExchangeRateService:
+    # Mantém a última cotação válida em memória. As rotas só leem o snapshot;
+    # a rede é consultada apenas pela tarefa de atualização em background.
+    # Uma cotação manual tem precedência sobre o provedor até ser retirada, e
+    # variações do provedor menores que min_change não mudam a cotação aplicada
+    # (nem disparam o repreço do catálogo).
+    def __init__(
+        self,
+        provider,
+        refresh_seconds: float = EXCHANGE_RATE_REFRESH_SECONDS,
+        timeout_seconds: float = EXCHANGE_RATE_TIMEOUT_SECONDS,
+        retry_seconds: float = EXCHANGE_RATE_RETRY_SECONDS,
+        max_backoff_seconds: float = EXCHANGE_RATE_MAX_BACKOFF_SECONDS,
+        min_change: float = EXCHANGE_RATE_MIN_CHANGE,
+        default_rate: float = DEFAULT_DOLLAR_RATE
+    ):
+        self.provider = provider
+        self.refresh_seconds = refresh_seconds
+        self.timeout_seconds = timeout_seconds
+        self.retry_seconds = retry_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.min_change = min_change
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.manual = False
+        self.provider_snapshot: Optional[RateSnapshot] = None  # última cotação lida do provedor
+        self._snapshot = RateSnapshot(rate=default_rate, updated_at=None, source="default")
+        self._task: Optional[asyncio.Task] = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        # callback assíncrono chamado com a nova cotação sempre que o provedor a altera
+        self._listeners.append(callback)
+
+    @property
+    def snapshot(self) -> RateSnapshot:
+        return self._snapshot
+
+    @property
+    def rate(self) -> float:
+        return self._snapshot.rate
+
+    def set_rate(self, rate: float, source: str = "manual"):
+        self._snapshot = RateSnapshot(rate=rate, updated_at=datetime.utcnow(), source=source)
+        self.manual = source == "manual"
+
+    def clear_manual_rate(self) -> Optional[float]:
+        # Volta a seguir o provedor. Devolve a cotação dele quando ela passa a
+        # valer na hora (None se não mudou nada ou se ainda não há leitura)
+        self.manual = False
+        if self.provider_snapshot is None or self.provider_snapshot.rate == self.rate:
+            return None
+        self._snapshot = self.provider_snapshot
+        return self.rate
+
+    async def refresh(self, client: httpx.AsyncClient) -> bool:
+        try:
+            rate = await self.provider.fetch(client)
+            if rate <= 0:
+                raise ValueError(f"invalid rate {rate}")
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"Error fetching dollar rate (attempt {self.failures}): {e}")
+            return False
+
+        self.failures = 0
+        self.last_error = None
+        self.provider_snapshot = RateSnapshot(rate=rate, updated_at=datetime.utcnow(), source="provider")
+        if self.manual:
+            return True
+
+        previous_rate = self.rate
+        if abs(rate - previous_rate) < previous_rate * self.min_change:
+            # Oscilação pequena: mantém a cotação aplicada, só confirma que segue atual
+            self._snapshot = RateSnapshot(rate=previous_rate, updated_at=datetime.utcnow(), source="provider")
+            return True
+
+        self.set_rate(rate, source="provider")
+        if rate != previous_rate:
+            for callback in self._listeners:
+                try:
+                    await callback(rate)
+                except Exception as e:
+                    print(f"Error notifying dollar rate change: {e}")
+        return True
+
+    def next_delay(self) -> float:
+        if self.failures == 0:
+            return self.refresh_seconds
+        # Backoff exponencial com jitter, limitado pelo intervalo máximo
+        delay = min(self.max_backoff_seconds, self.retry_seconds * 2 ** (self.failures - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def run(self):
+        async with httpx.AsyncClient(timeout=self.timeout_seconds) as client:
+            while True:
+                await self.refresh(client)
+                await asyncio.sleep(self.next_delay())
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+exchange_rate_service = ExchangeRateService(AwesomeApiRateProvider())
+
+
+# ===================== CACHE =====================
+
+CACHE_GLOBAL_VERSION_KEY = "cache:version:global"
+CACHE_INVALIDATION_CHANNEL = "cache:invalidate"
+
+def cache_version_key(owner: str) -> str:
+    return f"cache:version:{owner}"
+
+class LocalCache:
+    # LRU em memória com TTL e limite de memória. O tamanho de cada entrada é
+    # estimado pelo tamanho do JSON serializado.
+    def __init__(
+        self,
+        max_entries: int = LOCAL_CACHE_MAX_ENTRIES,
+        max_bytes: int = LOCAL_CACHE_MAX_BYTES,
+        ttl_seconds: float = LOCAL_CACHE_TTL_SECONDS
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value, size, tag)
+        self._tags = {}  # tag -> set(keys)
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value, size: int, tag: Optional[str] = None, ttl_seconds: Optional[float] = None):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        expires_at = time.monotonic() + (ttl_seconds or self.ttl_seconds)
+        self._entries[key] = (expires_at, value, size, tag)
+        self.size_bytes += size
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate_tag(self, tag: str):
+        for key in self._tags.pop(tag, set()):
+            self._remove(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+        self.size_bytes = 0
+
+    def _remove(self, key: str):
+        _, _, size, tag = self._entries.pop(key)
+        self.size_bytes -= size
+        if tag is not None and tag in self._tags:
+            self._tags[tag].discard(key)
+            if not self._tags[tag]:
+                del self._tags[tag]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes
+        }
 
+@dataclass
+class CacheVersion:
+    # Versões do cache lidas antes de o handler consultar o banco
+    local: tuple  # (geração global, geração do dono) da camada local
+    redis: Optional[str]  # "global.dono" no Redis; None se o Redis estava fora
+
+class TieredCache:
+    # Camada 1: LocalCache do processo. Camada 2: Redis, compartilhado entre workers.
+    # No Redis, as versões (global e do dono) entram na chave: invalidar é só um INCR
+    # e as entradas antigas expiram pelo TTL. A camada local é invalidada pelas
+    # mensagens de pub/sub dos outros workers. Se o Redis cair, o cache segue só
+    # local até REDIS_RETRY_SECONDS depois da falha (e a invalidação entre workers
+    # passa a depender do TTL local).
+    # Um resultado é gravado com as versões lidas antes da consulta ao banco: se
+    # houve invalidação no meio, ele cai numa versão já morta e não é servido.
+    def __init__(self, local: LocalCache, client, pubsub_client, retry_seconds: float = REDIS_RETRY_SECONDS):
+        self.local = local
+        self.redis = client
+        self.pubsub_client = pubsub_client
+        self.retry_seconds = retry_seconds
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+        self._redis_down_until = 0.0
+        self._global_generation = 0
+        self._owner_generations = {}
+        self._listener_task: Optional[asyncio.Task] = None
+
+    @property
+    def redis_available(self) -> bool:
+        return time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, error: Exception):
+        self.redis_errors += 1
+        self._redis_down_until = time.monotonic() + self.retry_seconds
+        print(f"Redis unavailable, using local cache only: {error}")
+
+    @staticmethod
+    def local_key(namespace: str, owner: str, params: dict) -> str:
+        params_digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return f"{namespace}:{owner}:{params_digest}"
+
+    def _local_generation(self, owner: str) -> tuple:
+        return self._global_generation, self._owner_generations.get(owner, 0)
+
+    async def _redis_version(self, owner: str) -> str:
+        global_version, owner_version = await self.redis.mget(CACHE_GLOBAL_VERSION_KEY, cache_version_key(owner))
+        return f"{global_version or 0}.{owner_version or 0}"
+
+    @staticmethod
+    def _redis_key(local_key: str, redis_version: str) -> str:
+        return f"cache:{local_key}:{redis_version}"
+
+    async def version(self, owner: str) -> CacheVersion:
+        local = self._local_generation(owner)
+        if not self.redis_available:
+            return CacheVersion(local, None)
+        try:
+            return CacheVersion(local, await self._redis_version(owner))
+        except RedisError as e:
+            self._redis_failed(e)
+            return CacheVersion(local, None)
 
+    async def get(self, namespace: str, owner: str, params: dict):
+        key = self.local_key(namespace, owner, params)
+        value = self.local.get(key)
+        if value is not None or not self.redis_available:
+            return value
 
-app = FastAPI()
+        try:
+            cached_data = await self.redis.get(self._redis_key(key, await self._redis_version(owner)))
+        except RedisError as e:
+            self._redis_failed(e)
+            return None
+
+        if cached_data is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        value = json.loads(cached_data)
+        self.local.set(key, value, len(cached_data), tag=owner)
+        return value
+
+    async def set(
+        self, namespace: str, owner: str, params: dict, value,
+        expire: int = CACHE_EXPIRE_SECONDS, version: Optional[CacheVersion] = None
+    ):
+        if version is None:
+            version = await self.version(owner)
+        key = self.local_key(namespace, owner, params)
+        value = jsonable_encoder(value)
+        data = json.dumps(value)
+        if version.local == self._local_generation(owner):
+            self.local.set(key, value, len(data), tag=owner, ttl_seconds=min(expire, self.local.ttl_seconds))
+        if version.redis is None or not self.redis_available:
+            return
+        try:
+            await self.redis.setex(self._redis_key(key, version.redis), expire, data)
+        except RedisError as e:
+            self._redis_failed(e)
+
+    def _invalidate_local(self, owner: Optional[str]):
+        if owner:
+            self._owner_generations[owner] = self._owner_generations.get(owner, 0) + 1
+            self.local.invalidate_tag(owner)
+        else:
+            self._global_generation += 1
+            self.local.clear()
+
+    async def invalidate(self, owner: Optional[str] = None):
+        # Sem dono, invalida o cache de todos (ex.: mudança na cotação do dólar)
+        self._invalidate_local(owner)
+        if not self.redis_available:
+            return
+        try:
+            await self.redis.incr(cache_version_key(owner) if owner else CACHE_GLOBAL_VERSION_KEY)
+            await self.redis.publish(CACHE_INVALIDATION_CHANNEL, json.dumps({"owner": owner, "origin": WORKER_ID}))
+        except RedisError as e:
+            self._redis_failed(e)
+
+    async def listen(self):
+        while True:
+            try:
+                async with self.pubsub_client.pubsub() as pubsub:
+                    await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        data = json.loads(message["data"])
+                        if data.get("origin") != WORKER_ID:
+                            self._invalidate_local(data.get("owner"))
+            except RedisError as e:
+                self._redis_failed(e)
+                # Mensagens podem ter sido perdidas enquanto estávamos desconectados
+                self._invalidate_local(None)
+                await asyncio.sleep(self.retry_seconds)
+
+    def start(self):
+        if self._listener_task is None or self._listener_task.done():
+            self._listener_task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+    def stats(self) -> dict:
+        return {
+            "local": self.local.stats(),
+            "redis": {
+                "hits": self.redis_hits,
+                "misses": self.redis_misses,
+                "errors": self.redis_errors,
+                "available": self.redis_available
+            }
+        }
+
+response_cache = TieredCache(LocalCache(), redis_client, redis_pubsub_client)
+
+
+# ===================== BROADCAST =====================
+
+BROADCAST_CHANNEL_PREFIX = "broadcast:"
+BROADCAST_ALL_CHANNEL = "broadcast:all"
+
+def broadcast_channel(owner: Optional[str]) -> str:
+    return f"{BROADCAST_CHANNEL_PREFIX}owner:{owner}" if owner else BROADCAST_ALL_CHANNEL
+
+class BroadcastBus:
+    # Eventos de dashboard/notificação passam pelo Redis para chegar aos sockets
+    # conectados em qualquer worker. O worker que publica entrega direto aos seus
+    # sockets e ignora o eco da própria mensagem. Com o Redis fora, a entrega
+    # fica restrita ao worker local até REDIS_RETRY_SECONDS depois da falha.
+    def __init__(self, client, pubsub_client, retry_seconds: float = REDIS_RETRY_SECONDS):
+        self.redis = client
+        self.pubsub_client = pubsub_client
+        self.retry_seconds = retry_seconds
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+        self._redis_down_until = 0.0
+        self._listeners = []
+        self._listener_task: Optional[asyncio.Task] = None
+
+    def add_listener(self, callback):
+        # callback assíncrono chamado com (owner, message) para entrega aos sockets locais
+        self._listeners.append(callback)
+
+    @property
+    def redis_available(self) -> bool:
+        return time.monotonic() >= self._redis_down_until
+
+    def _redis_failed(self, error: Exception):
+        self.errors += 1
+        self._redis_down_until = time.monotonic() + self.retry_seconds
+        print(f"Redis unavailable, broadcasting to local connections only: {error}")
+
+    async def _deliver(self, owner: Optional[str], message: dict):
+        for callback in self._listeners:
+            try:
+                await callback(owner, message)
+            except Exception as e:
+                print(f"Error delivering broadcast: {e}")
+
+    async def publish(self, owner: Optional[str], message: dict):
+        # owner=None: mensagem para todas as conexões
+        await self._deliver(owner, message)
+        if not self.redis_available:
+            return
+        try:
+            payload = json.dumps({"owner": owner, "message": message, "origin": WORKER_ID}, default=str)
+            await self.redis.publish(broadcast_channel(owner), payload)
+            self.published += 1
+        except RedisError as e:
+            self._redis_failed(e)
+
+    async def listen(self):
+        while True:
+            try:
+                async with self.pubsub_client.pubsub() as pubsub:
+                    await pubsub.psubscribe(f"{BROADCAST_CHANNEL_PREFIX}*")
+                    async for message in pubsub.listen():
+                        if message["type"] != "pmessage":
+                            continue
+                        data = json.loads(message["data"])
+                        if data.get("origin") == WORKER_ID:
+                            continue
+                        self.received += 1
+                        await self._deliver(data.get("owner"), data["message"])
+            except RedisError as e:
+                self._redis_failed(e)
+                await asyncio.sleep(self.retry_seconds)
+
+    def start(self):
+        if self._listener_task is None or self._listener_task.done():
+            self._listener_task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "received": self.received,
+            "errors": self.errors,
+            "available": self.redis_available
+        }
+
+broadcast_bus = BroadcastBus(redis_client, redis_pubsub_client)
+
+class DashboardConnection:
+    # Um socket com fila de envio limitada e uma task escritora própria: um
+    # cliente lento só acumula atraso na própria fila. Se a fila enche, os eventos
+    # mais antigos são descartados e o cliente recebe um único aviso
+    # "events_dropped" com a quantidade perdida antes do próximo evento.
+    # Conexões com heartbeat (protocolo 2, ou ?heartbeat=1 no protocolo 1)
+    # recebem {"type": "ping"} e precisam responder "pong"; as demais não
+    # recebem pings da aplicação e dependem do timeout de envio.
+    def __init__(
+        self, websocket: WebSocket, owner: str, protocol: int = 1,
+        heartbeat: bool = False, queue_size: int = WS_SEND_QUEUE_SIZE
+    ):
+        self.websocket = websocket
+        self.owner = owner
+        self.protocol = protocol
+        self.heartbeat = heartbeat or protocol >= 2
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.connected_at = time.monotonic()
+        self.sent = 0
+        self.dropped = 0
+        self.pending_dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.last_ping: Optional[float] = None
+        self.last_pong: Optional[float] = None
+        self.rtt: Optional[float] = None
+        self.closed = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self, send_timeout: float = WS_SEND_TIMEOUT_SECONDS):
+        self._writer = asyncio.create_task(self.run_writer(send_timeout))
+
+    def offer(self, message: dict):
+        if self.closed:
+            return
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.pending_dropped += 1
+        self.queue.put_nowait((time.monotonic(), message))
+
+    async def run_writer(self, send_timeout: float):
+        try:
+            while True:
+                enqueued_at, message = await self.queue.get()
+                if self.pending_dropped:
+                    notice = {"type": "events_dropped", "count": self.pending_dropped}
+                    self.pending_dropped = 0
+                    await asyncio.wait_for(self.websocket.send_json(notice), send_timeout)
+                await asyncio.wait_for(self.websocket.send_json(message), send_timeout)
+                self.sent += 1
+                self.last_lag = time.monotonic() - enqueued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Envio travado além do timeout ou socket quebrado
+            print(f"Closing slow or broken dashboard connection ({self.owner}): {e!r}")
+            await self.close(status.WS_1011_INTERNAL_ERROR, cancel_writer=False)
+
+    def ping(self, now: float) -> bool:
+        # Retorna False se o cliente não respondeu ao último ping em WS_PING_TIMEOUT_SECONDS
+        awaiting_pong = self.last_ping is not None and (self.last_pong is None or self.last_pong < self.last_ping)
+        if awaiting_pong:
+            return now - self.last_ping < WS_PING_TIMEOUT_SECONDS
+        self.last_ping = now
+        self.offer({"type": "ping", "timestamp": datetime.utcnow().isoformat()})
+        return True
+
+    def pong(self):
+        self.last_pong = time.monotonic()
+        if self.last_ping is not None:
+            self.rtt = self.last_pong - self.last_ping
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE, cancel_writer: bool = True):
+        if self.closed:
+            return
+        self.closed = True
+        if cancel_writer and self._writer is not None:
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "owner": self.owner,
+            "protocol": self.protocol,
+            "heartbeat": self.heartbeat,
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "rtt_ms": round(self.rtt * 1000, 1) if self.rtt is not None else None,
+            "connected_seconds": round(time.monotonic() - self.connected_at)
+        }
+
+class DeltaStream:
+    # Sequência de deltas de um dono neste worker, com os últimos eventos
+    # guardados para reenviar a quem reconecta
+    def __init__(self, buffer_size: int = WS_REPLAY_BUFFER_SIZE):
+        self.seq = 0
+        self.buffer = deque(maxlen=buffer_size)
+
+    def append(self, message: dict) -> dict:
+        self.seq += 1
+        message = {**message, "seq": self.seq}
+        self.buffer.append(message)
+        return message
+
+    def since(self, last_seq: int) -> Optional[List[dict]]:
+        # None se parte do intervalo já saiu do buffer (ou a sequência é de outra época)
+        if last_seq > self.seq:
+            return None
+        if last_seq < self.seq and (not self.buffer or self.buffer[0]["seq"] > last_seq + 1):
+            return None
+        return [m for m in self.buffer if m["seq"] > last_seq]
+
+class DashboardHub:
+    # Conexões de dashboard deste worker, por dono. O broadcast só enfileira:
+    # cada conexão envia no seu próprio ritmo, em paralelo com as demais.
+    # Conexões do protocolo 1 recebem as mensagens avulsas ("new_sale",
+    # "notification"); as do protocolo 2 recebem os deltas numerados. Cada
+    # worker numera os deltas por conta própria, por isso o snapshot informa a
+    # época (WORKER_ID) junto com a sequência.
+    def __init__(self, ping_interval: float = WS_PING_INTERVAL_SECONDS):
+        self.ping_interval = ping_interval
+        self.connections: dict = {}
+        self.streams: dict = {}
+        self._ping_task: Optional[asyncio.Task] = None
+
+    def register(self, websocket: WebSocket, owner: str, protocol: int = 1, heartbeat: bool = False) -> DashboardConnection:
+        # A task escritora só começa em connection.start(): o snapshot é enviado antes dela
+        connection = DashboardConnection(websocket, owner, protocol, heartbeat)
+        self.connections.setdefault(owner, set()).add(connection)
+        self.streams.setdefault(owner, DeltaStream())
+        return connection
+
+    def current_seq(self, owner: str) -> int:
+        return self.streams[owner].seq
+
+    def resume(self, connection: DashboardConnection, epoch: Optional[str], last_seq: Optional[int]) -> bool:
+        # Reenfileira os deltas perdidos desde last_seq; False se é preciso um snapshot novo
+        if epoch != WORKER_ID or last_seq is None:
+            return False
+        missed = self.streams[connection.owner].since(last_seq)
+        if missed is None or len(missed) >= connection.queue.maxsize:
+            return False
+        connection.offer({"type": "resume", "version": DASHBOARD_PROTOCOL_VERSION, "epoch": WORKER_ID, "seq": last_seq})
+        for message in missed:
+            connection.offer(message)
+        return True
+
+    async def unregister(self, connection: DashboardConnection):
+        owner_connections = self.connections.get(connection.owner)
+        if owner_connections is not None:
+            owner_connections.discard(connection)
+            if not owner_connections:
+                del self.connections[connection.owner]
+        await connection.close()
+
+    def all_connections(self) -> List[DashboardConnection]:
+        return [c for owner_connections in self.connections.values() for c in owner_connections]
+
+    def broadcast(self, owner: Optional[str], message: dict):
+        # owner=None: todas as conexões
+        if message.get("type") == "delta":
+            owners = list(self.streams) if owner is None else [owner]
+            for delta_owner in owners:
+                stream = self.streams.get(delta_owner)
+                if stream is None:
+                    # Dono sem conexões neste worker
+                    continue
+                sequenced = stream.append(message)
+                for connection in list(self.connections.get(delta_owner, ())):
+                    if connection.protocol >= 2:
+                        connection.offer(sequenced)
+            return
+
+        targets = self.all_connections() if owner is None else list(self.connections.get(owner, ()))
+        for connection in targets:
+            if connection.protocol < 2:
+                connection.offer(message)
+
+    async def deliver(self, owner: Optional[str], message: dict):
+        self.broadcast(owner, message)
+
+    async def run_pings(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for connection in self.all_connections():
+                if connection.heartbeat and not connection.ping(now):
+                    print(f"Dashboard connection stopped answering pings ({connection.owner})")
+                    await self.unregister(connection)
+
+    def start(self):
+        if self._ping_task is None or self._ping_task.done():
+            self._ping_task = asyncio.create_task(self.run_pings())
+
+    async def stop(self):
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+            try:
+                await self._ping_task
+            except asyncio.CancelledError:
+                pass
+            self._ping_task = None
+        for connection in self.all_connections():
+            await self.unregister(connection)
+
+    def stats(self, top: int = 20) -> dict:
+        connections = [c.stats() for c in self.all_connections()]
+        return {
+            "connections": len(connections),
+            "owners": len(self.connections),
+            "epoch": WORKER_ID,
+            "sequences": {owner: stream.seq for owner, stream in self.streams.items()},
+            "queued": sum(c["queued"] for c in connections),
+            "sent": sum(c["sent"] for c in connections),
+            "dropped": sum(c["dropped"] for c in connections),
+            "max_lag_ms": max((c["max_lag_ms"] for c in connections), default=0.0),
+            # Conexões mais atrasadas primeiro
+            "slowest": sorted(connections, key=lambda c: (c["queued"], c["last_lag_ms"]), reverse=True)[:top]
+        }
+
+dashboard_hub = DashboardHub()
+broadcast_bus.add_listener(dashboard_hub.deliver)
+
+class SaleEventBatcher:
+    # Agrega as vendas de cada dono por SALE_BATCH_WINDOW_SECONDS (a partir da
+    # primeira venda da janela) e entrega um único lote ao listener: contadores
+    # somados por produto e o último estado de cada produto do dashboard. Um lote
+    # com SALE_BATCH_MAX_EVENTS vendas é entregue na hora.
+    def __init__(self, window_seconds: float = SALE_BATCH_WINDOW_SECONDS, max_events: int = SALE_BATCH_MAX_EVENTS):
+        self.window_seconds = window_seconds
+        self.max_events = max_events
+        self.events = 0
+        self.batches = 0
+        self._pending: dict = {}
+        self._listeners = []
+
+    def add_listener(self, callback):
+        # callback assíncrono chamado com (owner, sales, products) a cada lote
+        self._listeners.append(callback)
+
+    async def add(self, owner: str, sale: dict, products: List[dict]):
+        # `sale` é o "data" de uma mensagem new_sale; `products`, os deltas do dashboard
+        self.events += 1
+        batch = self._pending.get(owner)
+        if batch is None:
+            batch = self._pending[owner] = {"sales": [], "products": {}, "timer": None}
+            if self.window_seconds > 0:
+                batch["timer"] = asyncio.create_task(self._flush_later(owner, batch))
+        batch["sales"].append(sale)
+        for product in products:
+            # Vendas concorrentes podem chegar fora de ordem: sold_quantity só cresce
+            current = batch["products"].get(product["original_id"])
+            if current is None or product["sold_quantity"] >= current["sold_quantity"]:
+                batch["products"][product["original_id"]] = product
+        if self.window_seconds <= 0 or len(batch["sales"]) >= self.max_events:
+            await self.flush(owner)
+
+    async def _flush_later(self, owner: str, batch: dict):
+        await asyncio.sleep(self.window_seconds)
+        if self._pending.get(owner) is batch:
+            batch["timer"] = None
+            await self.flush(owner)
+
+    async def flush(self, owner: str):
+        batch = self._pending.pop(owner, None)
+        if batch is None:
+            return
+        if batch["timer"] is not None:
+            batch["timer"].cancel()
+        self.batches += 1
+        for callback in self._listeners:
+            try:
+                await callback(owner, batch["sales"], list(batch["products"].values()))
+            except Exception as e:
+                print(f"Error publishing sale batch: {e}")
+
+    async def stop(self):
+        # Entrega o que estiver pendente
+        for owner in list(self._pending):
+            await self.flush(owner)
+
+    def stats(self) -> dict:
+        return {
+            "events": self.events,
+            "batches": self.batches,
+            "pending_owners": len(self._pending),
+            "window_seconds": self.window_seconds
+        }
+
+sale_batcher = SaleEventBatcher()
+
+
+# ===================== BUSCA DE PRODUTOS =====================
+
+# Índice FTS5 (external content) sobre products.description, mantido por triggers:
+# qualquer INSERT/UPDATE/DELETE em products (criação, edição, exclusão, venda que
+# esgota o estoque, importação em lote) atualiza o índice na mesma transação.
+# remove_diacritics faz "eletronicos" encontrar "Eletrônicos".
+PRODUCT_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        description,
+        content='products',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3 4'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, description) VALUES (new.id, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, description) VALUES ('delete', old.id, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF description ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        INSERT INTO products_fts(rowid, description) VALUES (new.id, new.description);
+    END""",
+]
+
+products_fts = table("products_fts", literal_column("rowid"), literal_column("rank"))
+
+def product_search_enabled() -> bool:
+    return engine.dialect.name == "sqlite"
+
+def init_product_search():
+    if not product_search_enabled():
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")).first()
+        for ddl in PRODUCT_SEARCH_DDL:
+            conn.execute(text(ddl))
+        if not exists:
+            # Indexa os produtos que já existiam antes do índice
+            conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+
+def product_search_query(terms: str) -> Optional[str]:
+    # Cada palavra vira um termo de prefixo ("note"* "dell"*), todos obrigatórios.
+    # Tokens de uma letra casam só a palavra exata: um prefixo tão curto
+    # obrigaria a ranquear boa parte do catálogo.
+    tokens = re.findall(r"\w+", terms)
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' if len(token) > 1 else f'"{token}"' for token in tokens)
+
+def apply_product_search(query, terms: str):
+    # Filtra e ordena por relevância (bm25). Fora do SQLite, cai no ILIKE.
+    if not product_search_enabled():
+        return query.filter(Product.description.ilike(f"%{terms}%")).order_by(Product.id)
+
+    match = product_search_query(terms)
+    if match is None:
+        return query.filter(False)
+    return (
+        query
+        .join(products_fts, products_fts.c.rowid == Product.id)
+        .filter(literal_column("products_fts").op("MATCH")(match))
+        .order_by(products_fts.c.rank, Product.id)
+    )
+
+
+# ===================== INICIALIZAÇÃO =====================
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    exchange_rate_service.start()
+    response_cache.start()
+    broadcast_bus.start()
+    dashboard_hub.start()
+    yield
+    await sale_batcher.stop()
+    await dashboard_hub.stop()
+    await broadcast_bus.stop()
+    await response_cache.stop()
+    await exchange_rate_service.stop()
+    db_executor.shutdown(wait=False)
+    analytics_executor.shutdown(wait=False)
+    password_executor.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS Configuration
 app.add_middleware(
@@ -203,22 +1271,89 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 # Database Configuration
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL: leituras não bloqueiam a escrita; synchronous=NORMAL é seguro em WAL
+    # e evita um fsync por commit; busy_timeout espera o lock em vez de falhar
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+def create_db_engine(url: str):
+    options = {
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE
+    }
+    in_memory = url in ("sqlite://", "sqlite:///:memory:")
+    if not in_memory:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+
+    if not url.startswith("sqlite"):
+        return create_engine(url, **options)
+
+    sqlite_engine = create_engine(url, connect_args={"check_same_thread": False}, **options)
+    if not in_memory:
+        event.listen(sqlite_engine, "connect", set_sqlite_pragmas)
+    return sqlite_engine
+
+SQLALCHEMY_DATABASE_URL = DATABASE_URL
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# Redis Configuration
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+analytics_executor = ThreadPoolExecutor(max_workers=ANALYTICS_WORKERS, thread_name_prefix="analytics")
+
+async def run_db(func, *args, **kwargs):
+    # Executa código síncrono do SQLAlchemy sem bloquear o event loop
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+async def run_analytics(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(analytics_executor, partial(func, *args, **kwargs))
+
+# bcrypt libera o GIL, então threads bastam. O semáforo conta os jobs enfileirados
+# e em execução e só é liberado quando o job termina de fato.
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt")
+password_slots = threading.BoundedSemaphore(PASSWORD_MAX_PENDING)
+password_jobs = {"completed": 0, "rejected": 0, "timeouts": 0}
+
+async def run_password_job(func, *args):
+    if not password_slots.acquire(blocking=False):
+        password_jobs["rejected"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again shortly",
+            headers={"Retry-After": "1"}
+        )
+    try:
+        future = password_executor.submit(func, *args)
+    except Exception:
+        password_slots.release()
+        raise
+    future.add_done_callback(lambda _: password_slots.release())
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), PASSWORD_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        password_jobs["timeouts"] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Authentication is overloaded, try again shortly",
+            headers={"Retry-After": "5"}
+        )
+    password_jobs["completed"] += 1
+    return result
 
 # Authentication Utilities
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes com outro custo são regravados no próximo login (verify_and_update)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=PASSWORD_BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
-# Fake user database
-fake_users_db = {
+# Usuários iniciais, gravados na tabela users pelo init_db
+DEFAULT_USERS = {
     "user@example.com": {
         "username": "user@example.com",
         "email": "user@example.com",
@@ -227,11 +1362,6 @@ fake_users_db = {
     }
 }
 
-# Global variables
-current_dollar_rate = 5.0
-active_connections = []
-active_connections_ws2 = {}
-
 
 
 # ===================== FUNC. P/ AJUDAR   =====================
@@ -242,19 +1372,77 @@ def verify_password(plain_password: str, hashed_password: str):
 def get_password_hash(password: str):
     return pwd_context.hash(password)
 
-def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDB(**user_dict)
+def user_in_db(account: UserAccount) -> UserInDB:
+    return UserInDB(
+        username=account.username,
+        email=account.email,
+        hashed_password=account.hashed_password,
+        disabled=bool(account.disabled)
+    )
+
+def get_user(db: Session, username: str) -> Optional[UserInDB]:
+    account = db.query(UserAccount).filter(UserAccount.username == username).first()
+    return user_in_db(account) if account else None
+
+def load_user(username: str) -> Optional[UserInDB]:
+    # Para o cache de usuários: roda fora do event loop com sessão própria
+    db = SessionLocal()
+    try:
+        return get_user(db, username)
+    finally:
+        db.close()
+
+def update_password_hash(db: Session, username: str, hashed_password: str):
+    db.execute(
+        update(UserAccount)
+        .where(UserAccount.username == username)
+        .values(hashed_password=hashed_password)
+    )
+    db.commit()
 
-def authenticate_user(fake_db, username: str, password: str):
-    user = get_user(fake_db, username)
+async def authenticate_user(db: Session, username: str, password: str):
+    # Banco pelo db_executor e só o bcrypt no pool de senhas: a sessão nunca é
+    # usada pelas threads do bcrypt (nem depois de um timeout de run_password_job)
+    user = await run_db(get_user, db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await run_password_job(pwd_context.verify_and_update, password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # Parâmetros do hash mudaram: regrava com o custo atual
+        await run_db(update_password_hash, db, username, new_hash)
+        user.hashed_password = new_hash
     return user
 
+def create_user(db: Session, user: UserCreate, hashed_password: str) -> UserInDB:
+    account = UserAccount(
+        username=user.username,
+        email=user.email,
+        hashed_password=hashed_password,
+        disabled=0
+    )
+    db.add(account)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Username or email already registered")
+    db.refresh(account)
+    return user_in_db(account)
+
+def seed_users(db: Session):
+    existing = {username for username, in db.query(UserAccount.username)}
+    for username, user in DEFAULT_USERS.items():
+        if username not in existing:
+            db.add(UserAccount(
+                username=user["username"],
+                email=user["email"],
+                hashed_password=user["hashed_password"],
+                disabled=1 if user["disabled"] else 0
+            ))
+    db.commit()
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -265,14 +1453,75 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_dollar_exchange_rate():
+# Tokens verificados, pelo digest do token, valendo até o `exp`; e usuários por
+# username. As entradas levam o username como tag para invalidar as duas juntas.
+token_cache = LocalCache(max_entries=AUTH_TOKEN_CACHE_MAX_ENTRIES, ttl_seconds=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+principal_cache = LocalCache(max_entries=AUTH_PRINCIPAL_CACHE_MAX_ENTRIES, ttl_seconds=AUTH_PRINCIPAL_CACHE_TTL_SECONDS)
+auth_timing = {"requests": 0, "failures": 0, "seconds": 0.0}
+
+def verify_token(token: str) -> Optional[str]:
+    # Username de um token válido, ou None
+    key = hashlib.sha256(token.encode()).hexdigest()
+    username = token_cache.get(key)
+    if username is not None:
+        return username
     try:
-        response = requests.get("https://economia.awesomeapi.com.br/json/last/USD-BRL")
-        data = response.json()
-        return float(data["USDBRL"]["bid"])
-    except Exception as e:
-        print(f"Error fetching dollar rate: {e}")
-        return 5.0  # Default value
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    if not username:
+        return None
+    ttl_seconds = payload["exp"] - time.time() if "exp" in payload else None
+    if ttl_seconds is None or ttl_seconds > 0:
+        token_cache.set(key, username, 1, tag=username, ttl_seconds=ttl_seconds)
+    return username
+
+def cache_principal(user: UserInDB):
+    principal_cache.set(user.username, user, 1, tag=user.username)
+
+async def resolve_principal(username: str) -> Optional[UserInDB]:
+    # Acerto no cache não toca o banco. Entre workers, mudanças no usuário
+    # valem em até AUTH_PRINCIPAL_CACHE_TTL_SECONDS.
+    user = principal_cache.get(username)
+    if user is None:
+        user = await run_db(load_user, username)
+        if user is None:
+            return None
+        cache_principal(user)
+    return user
+
+async def authenticate_token(token: str) -> Optional[UserInDB]:
+    # Caminho único de autenticação por token, usado pelo HTTP e pelo WebSocket
+    started = time.perf_counter()
+    try:
+        username = verify_token(token)
+        user = await resolve_principal(username) if username else None
+        if user is None:
+            auth_timing["failures"] += 1
+        return user
+    finally:
+        auth_timing["requests"] += 1
+        auth_timing["seconds"] += time.perf_counter() - started
+
+def invalidate_principal(username: str):
+    token_cache.invalidate_tag(username)
+    principal_cache.invalidate_tag(username)
+
+def auth_stats() -> dict:
+    requests = auth_timing["requests"]
+    return {
+        "requests": requests,
+        "failures": auth_timing["failures"],
+        "avg_microseconds": round(auth_timing["seconds"] / requests * 1e6, 1) if requests else 0.0,
+        "tokens": token_cache.stats(),
+        "principals": principal_cache.stats(),
+        "password_checks": {
+            **password_jobs,
+            "workers": PASSWORD_WORKERS,
+            "max_pending": PASSWORD_MAX_PENDING
+        }
+    }
 
 def calculate_status(quantity: int, suggested_quantity: int) -> Status:
     if quantity < suggested_quantity:
@@ -282,6 +1531,362 @@ def calculate_status(quantity: int, suggested_quantity: int) -> Status:
     else:
         return Status.green
 
+def status_expression(quantity, suggested_quantity):
+    # Mesma regra de calculate_status, avaliada pelo banco dentro do UPDATE
+    return cast(
+        case(
+            (quantity < suggested_quantity, Status.red.value),
+            (quantity - suggested_quantity <= 5, Status.yellow.value),
+            else_=Status.green.value
+        ),
+        Product.status.type
+    )
+
+def product_available():
+    # Não excluído e com estoque; o 0 literal casa com o índice parcial
+    return and_(Product.deleted_at.is_(None), Product.quantity > literal_column("0"))
+
+AUDIT_BUFFER_KEY = "audit_events"
+AUDIT_BUFFER_STARTED_KEY = "audit_events_started"
+
+def product_history_entry(product, action: str, action_reason: Optional[str] = None) -> dict:
+    action_date = datetime.utcnow().isoformat()
+    return {
+        "original_id": product.id,
+        "description": product.description,
+        "image_url": product.image_url,
+        "quantity": product.quantity,
+        "suggested_quantity": product.suggested_quantity,
+        "price_brl": product.price_brl,
+        "price_usd": product.price_usd,
+        "status": product.status,
+        "categories": product.categories,
+        "owner": product.owner,
+        "action": action,
+        "action_date": action_date,
+        "action_reason": action_reason,
+        "action_month": action_date[:7]
+    }
+
+def record_history(db: Session, product, action: str, action_reason: Optional[str] = None):
+    # Acumula o evento na sessão; vai ao banco num INSERT em lote antes do commit
+    # (ou antes, se o lote enche ou fica velho). Rollback descarta os eventos.
+    buffer = db.info.setdefault(AUDIT_BUFFER_KEY, [])
+    if not buffer:
+        db.info[AUDIT_BUFFER_STARTED_KEY] = time.monotonic()
+    buffer.append(product_history_entry(product, action, action_reason))
+    if len(buffer) >= AUDIT_BATCH_SIZE or time.monotonic() - db.info[AUDIT_BUFFER_STARTED_KEY] >= AUDIT_FLUSH_SECONDS:
+        flush_history(db)
+
+def flush_history(db: Session):
+    buffer = db.info.pop(AUDIT_BUFFER_KEY, None)
+    if buffer:
+        db.execute(insert(ProductHistory), buffer)
+
+@event.listens_for(SessionLocal, "before_commit")
+def flush_history_before_commit(session):
+    flush_history(session)
+
+@event.listens_for(SessionLocal, "after_transaction_end")
+def discard_history_after_transaction(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(AUDIT_BUFFER_KEY, None)
+
+def purge_product_history(db: Session, keep_months: int) -> int:
+    # Apaga os meses mais antigos que os `keep_months` mais recentes (incluindo o atual)
+    today = datetime.utcnow().date()
+    month_index = today.year * 12 + today.month - 1 - (keep_months - 1)
+    cutoff = f"{month_index // 12:04d}-{month_index % 12 + 1:02d}"
+    result = db.execute(
+        delete(ProductHistory)
+        .where(ProductHistory.action_month < cutoff)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
+
+def dialect_insert(model):
+    # INSERT com suporte a ON CONFLICT no dialeto em uso
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+def normalize_categories(categories) -> List[str]:
+    # Aceita lista ou string separada por vírgulas; remove vazios e duplicados
+    if isinstance(categories, str):
+        categories = categories.split(",")
+    names = []
+    for name in categories or []:
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def get_category_ids(db: Session, names: List[str]) -> dict:
+    if not names:
+        return {}
+    db.execute(dialect_insert(Category).on_conflict_do_nothing(index_elements=["name"]), [{"name": n} for n in names])
+    return dict(db.query(Category.name, Category.id).filter(Category.name.in_(names)).all())
+
+def set_product_categories(db: Session, product_id: int, names: List[str]):
+    # Sincroniza a associação com a lista de categorias do produto. Não faz commit.
+    category_ids = set(get_category_ids(db, names).values())
+    db.execute(
+        delete(ProductCategory)
+        .where(ProductCategory.product_id == product_id, ProductCategory.category_id.notin_(category_ids))
+        .execution_options(synchronize_session=False)
+    )
+    if category_ids:
+        db.execute(
+            dialect_insert(ProductCategory).on_conflict_do_nothing(),
+            [{"product_id": product_id, "category_id": category_id} for category_id in category_ids]
+        )
+
+def backfill_product_categories(db: Session) -> int:
+    # Migra as strings de Product.categories para a tabela de associação
+    rows = db.query(Product.id, Product.categories).all()
+    names = {name for _, categories in rows for name in normalize_categories(categories)}
+    category_ids = get_category_ids(db, sorted(names))
+    links = [
+        {"product_id": product_id, "category_id": category_ids[name]}
+        for product_id, categories in rows
+        for name in normalize_categories(categories)
+    ]
+    if links:
+        db.execute(dialect_insert(ProductCategory).on_conflict_do_nothing(), links)
+    db.commit()
+    return len(links)
+
+def backfill_product_state(db: Session) -> int:
+    # Bancos anteriores à exclusão lógica: vendidos e última atualização ficavam
+    # em dashboard_products, e produtos esgotados ou excluídos eram apagados. Os
+    # apagados que ainda constam lá voltam como excluídos (com suas categorias)
+    # para as vendas continuarem ligadas a eles. Única implementação, chamada
+    # pelo init_db quando acabou de criar a coluna e pela migração 9c41e6d2f8b7.
+    pending = db.query(Product.id).filter(Product.sold_quantity.is_(None)).all()
+    if not pending:
+        return 0
+
+    now = datetime.utcnow().isoformat()
+    dashboard = {}
+    if "dashboard_products" in inspect(db.connection()).get_table_names():
+        rows = db.execute(text(
+            "SELECT original_id, owner, description, image_url, current_quantity, suggested_quantity, "
+            "price_brl, price_usd, status, categories, sold_quantity, last_update "
+            "FROM dashboard_products ORDER BY id"
+        )).mappings()
+        dashboard = {row["original_id"]: row for row in rows}
+
+    db.execute(update(Product), [{
+        "id": product_id,
+        "sold_quantity": (dashboard[product_id]["sold_quantity"] or 0) if product_id in dashboard else 0,
+        "last_update": (dashboard[product_id]["last_update"] or now) if product_id in dashboard else now
+    } for product_id, in pending])
+
+    existing = {product_id for product_id, in db.query(Product.id)}
+    restored = [{
+        "id": product_id,
+        "description": row["description"],
+        "image_url": row["image_url"],
+        "quantity": row["current_quantity"] or 0,
+        "suggested_quantity": row["suggested_quantity"],
+        "price_brl": row["price_brl"],
+        "price_usd": row["price_usd"],
+        "status": row["status"],
+        "categories": row["categories"],
+        "owner": row["owner"],
+        "sold_quantity": row["sold_quantity"] or 0,
+        "last_update": row["last_update"] or now,
+        "deleted_at": row["last_update"] or now
+    } for product_id, row in dashboard.items() if product_id not in existing]
+    if restored:
+        db.execute(insert(Product), restored)
+        for row in restored:
+            set_product_categories(db, row["id"], normalize_categories(row["categories"]))
+    db.commit()
+    return len(pending) + len(restored)
+
+def products_in_categories(names: List[str]):
+    # Subconsulta indexada: ids de produtos que têm qualquer uma das categorias
+    return (
+        select(ProductCategory.product_id)
+        .join(Category, Category.id == ProductCategory.category_id)
+        .where(Category.name.in_(names))
+    )
+
+def product_response(p: Product) -> "ProductResponse":
+    return ProductResponse(
+        id=p.id,
+        description=p.description,
+        image_url=p.image_url,
+        quantity=p.quantity,
+        suggested_quantity=p.suggested_quantity,
+        price=p.price_brl,
+        price_usd=p.price_usd,
+        status=p.status,
+        categories=normalize_categories(p.categories),
+        owner=p.owner
+    )
+
+def upsert_sales_daily(db: Session, rows: List[dict]):
+    stmt = dialect_insert(SalesDaily)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["owner", "day", "product_id"],
+        set_={
+            "categories": stmt.excluded.categories,
+            "quantity": SalesDaily.quantity + stmt.excluded.quantity,
+            "revenue_brl": SalesDaily.revenue_brl + stmt.excluded.revenue_brl,
+            "revenue_usd": SalesDaily.revenue_usd + stmt.excluded.revenue_usd
+        }
+    )
+    db.execute(stmt, rows)
+
+def rebuild_sales_rollup(db: Session, owner: Optional[str] = None) -> int:
+    # Recalcula o rollup a partir da tabela de vendas (backfill / correção)
+    clear = delete(SalesDaily)
+    if owner:
+        clear = clear.where(SalesDaily.owner == owner)
+    db.execute(clear)
+
+    day = func.substr(Sale.sale_date, 1, 10)
+    source = (
+        select(
+            Sale.owner,
+            day,
+            Sale.product_id,
+            func.max(Product.categories),
+            func.sum(Sale.quantity),
+            func.sum(Sale.sale_value_brl),
+            func.sum(Sale.sale_value_usd)
+        )
+        .outerjoin(Product, Product.id == Sale.product_id)
+        .group_by(Sale.owner, day, Sale.product_id)
+    )
+    if owner:
+        source = source.where(Sale.owner == owner)
+
+    result = db.execute(
+        insert(SalesDaily).from_select(
+            ["owner", "day", "product_id", "categories", "quantity", "revenue_brl", "revenue_usd"],
+            source
+        )
+    )
+    db.commit()
+    return result.rowcount
+
+def upsert_product_totals(db: Session, rows: List[dict]):
+    stmt = dialect_insert(ProductSalesTotal)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["owner", "product_id"],
+        set_={
+            "description": stmt.excluded.description,
+            "quantity": ProductSalesTotal.quantity + stmt.excluded.quantity,
+            "revenue_brl": ProductSalesTotal.revenue_brl + stmt.excluded.revenue_brl,
+            "revenue_usd": ProductSalesTotal.revenue_usd + stmt.excluded.revenue_usd
+        }
+    )
+    db.execute(stmt, rows)
+
+def rebuild_product_totals(db: Session, owner: Optional[str] = None) -> int:
+    # Recalcula o placar a partir das vendas. Produtos já removidos levam a
+    # última descrição registrada no histórico.
+    clear = delete(ProductSalesTotal)
+    totals = db.query(
+        Sale.owner,
+        Sale.product_id,
+        func.sum(Sale.quantity),
+        func.sum(Sale.sale_value_brl),
+        func.sum(Sale.sale_value_usd)
+    ).group_by(Sale.owner, Sale.product_id)
+    history_names = db.query(ProductHistory.owner, ProductHistory.original_id, ProductHistory.description).order_by(ProductHistory.id)
+    product_names = db.query(Product.owner, Product.id, Product.description)
+    if owner:
+        clear = clear.where(ProductSalesTotal.owner == owner)
+        totals = totals.filter(Sale.owner == owner)
+        history_names = history_names.filter(ProductHistory.owner == owner)
+        product_names = product_names.filter(Product.owner == owner)
+    db.execute(clear)
+
+    names = {(o, product_id): description for o, product_id, description in history_names}
+    names.update({(o, product_id): description for o, product_id, description in product_names})
+    rows = [{
+        "owner": o,
+        "product_id": product_id,
+        "description": names.get((o, product_id)),
+        "quantity": quantity,
+        "revenue_brl": revenue_brl,
+        "revenue_usd": revenue_usd
+    } for o, product_id, quantity, revenue_brl, revenue_usd in totals]
+    if rows:
+        db.execute(insert(ProductSalesTotal), rows)
+    db.commit()
+    return len(rows)
+
+def top_products_leaderboard(
+    db: Session,
+    owner: str,
+    metric: LeaderboardMetric,
+    days: Optional[int],
+    limit: int
+) -> List[dict]:
+    if days is None:
+        # Acumulado: top-N lido direto do índice (owner, métrica)
+        order = ProductSalesTotal.quantity if metric == LeaderboardMetric.quantity else ProductSalesTotal.revenue_brl
+        rows = (
+            db.query(
+                ProductSalesTotal.product_id,
+                ProductSalesTotal.description,
+                ProductSalesTotal.quantity,
+                ProductSalesTotal.revenue_brl
+            )
+            .filter(ProductSalesTotal.owner == owner)
+            .order_by(order.desc(), ProductSalesTotal.product_id.desc())
+            .limit(limit)
+            .all()
+        )
+    else:
+        # Janela móvel dos últimos `days` dias, pelo rollup diário
+        since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+        quantity = func.sum(SalesDaily.quantity)
+        revenue = func.sum(SalesDaily.revenue_brl)
+        rows = (
+            db.query(SalesDaily.product_id, func.max(ProductSalesTotal.description), quantity, revenue)
+            .outerjoin(ProductSalesTotal, and_(
+                ProductSalesTotal.owner == SalesDaily.owner,
+                ProductSalesTotal.product_id == SalesDaily.product_id
+            ))
+            .filter(SalesDaily.owner == owner, SalesDaily.day >= since)
+            .group_by(SalesDaily.product_id)
+            .order_by((quantity if metric == LeaderboardMetric.quantity else revenue).desc())
+            .limit(limit)
+            .all()
+        )
+
+    return [{
+        "product_id": product_id,
+        "name": description or f"Produto #{product_id}",
+        "sales": sales,
+        "revenue": revenue_brl
+    } for product_id, description, sales, revenue_brl in rows]
+
+def encode_cursor(values: list) -> str:
+    # Cursor opaco: os valores da chave de ordenação do último item da página
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def set_next_cursor(response: Response, page: list, limit: int, key):
+    # Página cheia: pode haver mais itens depois do último
+    if len(page) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(key(page[-1]))
+
 def get_db():
     db = SessionLocal()
     try:
@@ -289,25 +1894,207 @@ def get_db():
     finally:
         db.close()
 
-def update_product_prices(db: Session):
-    products = db.query(Product).all()
-    for product in products:
-        product.price_usd = round(product.price_brl / current_dollar_rate, 2)
-    db.commit()
+def reprice_table(db: Session, model, rate: float, chunk_size: int = REPRICE_CHUNK_SIZE) -> int:
+    # UPDATE em lote por faixas de id: nenhuma linha é carregada no ORM
+    min_id, max_id = db.query(func.min(model.id), func.max(model.id)).one()
+    if min_id is None:
+        return 0
+
+    new_price = func.round(cast(model.price_brl / rate, Numeric), 2)
+    updated = 0
+    for start in range(min_id, max_id + 1, chunk_size):
+        result = db.execute(
+            update(model)
+            .where(model.id >= start, model.id < start + chunk_size)
+            .where(or_(model.price_usd.is_(None), model.price_usd != new_price))
+            .values(price_usd=new_price)
+            .execution_options(synchronize_session=False)
+        )
+        updated += result.rowcount
+    return updated
 
-async def broadcast_message(message: str, message_type: str = "notification"):
-    for connection in active_connections:
+def update_product_prices(db: Session, rate: Optional[float] = None) -> dict:
+    if rate is None:
+        rate = exchange_rate_service.rate
+    try:
+        counts = {
+            Product.__tablename__: reprice_table(db, Product, rate)
+        }
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return counts
+
+async def reprice_on_rate_change(rate: float):
+    def _reprice():
+        db = SessionLocal()
         try:
-            await connection.send_json({
-                "type": message_type,
-                "message": message,
-                "timestamp": datetime.utcnow().isoformat()
-            })
-        except:
-            active_connections.remove(connection)
+            return update_product_prices(db, rate)
+        finally:
+            db.close()
+
+    counts = await run_db(_reprice)
+    await invalidate_cache()
+    await broadcast_dashboard_delta(None, {"exchange_rate": exchange_rate_response()})
+    print(f"Dollar rate changed to {rate}, repriced: {counts}")
+
+exchange_rate_service.add_listener(reprice_on_rate_change)
+
+def decrement_stock(db: Session, owner: str, product_id: int, quantity: int):
+    # Checagem e baixa de estoque num único UPDATE condicional: dois compradores
+    # concorrentes nunca conseguem vender a mesma unidade.
+    new_quantity = Product.quantity - quantity
+    return db.execute(
+        update(Product)
+        .where(
+            Product.id == product_id,
+            Product.owner == owner,
+            Product.deleted_at.is_(None),
+            Product.quantity >= quantity
+        )
+        .values(
+            quantity=new_quantity,
+            status=status_expression(new_quantity, Product.suggested_quantity),
+            sold_quantity=Product.sold_quantity + quantity,
+            last_update=datetime.utcnow().isoformat()
+        )
+        .returning(
+            Product.id, Product.description, Product.image_url, Product.quantity,
+            Product.suggested_quantity, Product.price_brl, Product.price_usd,
+            Product.status, Product.categories, Product.owner,
+            Product.sold_quantity, Product.last_update
+        )
+        .execution_options(synchronize_session=False)
+    ).first()
+
+def record_sales(db: Session, owner: str, sold: list) -> List[dict]:
+    # `sold` é uma lista de (produto após a baixa, quantidade vendida).
+    # Vendas, rollups e histórico entram na transação corrente; não faz commit.
+    sale_date = datetime.utcnow().isoformat()
+    sale_rows = [{
+        "product_id": product.id,
+        "quantity": quantity,
+        "sale_date": sale_date,
+        "sale_value_brl": product.price_brl * quantity,
+        "sale_value_usd": product.price_usd * quantity,
+        "owner": owner
+    } for product, quantity in sold]
+    db.execute(insert(Sale), sale_rows)
+    upsert_sales_daily(db, [{
+        "owner": owner,
+        "day": sale_date[:10],
+        "product_id": product.id,
+        "categories": product.categories,
+        "quantity": sale_row["quantity"],
+        "revenue_brl": sale_row["sale_value_brl"],
+        "revenue_usd": sale_row["sale_value_usd"]
+    } for (product, _), sale_row in zip(sold, sale_rows)])
+    upsert_product_totals(db, [{
+        "owner": owner,
+        "product_id": product.id,
+        "description": product.description,
+        "quantity": sale_row["quantity"],
+        "revenue_brl": sale_row["sale_value_brl"],
+        "revenue_usd": sale_row["sale_value_usd"]
+    } for (product, _), sale_row in zip(sold, sale_rows)])
+
+    results = []
+    for (product, quantity), sale_row in zip(sold, sale_rows):
+        if product.quantity <= 0:
+            # Esgotado: sai da listagem de produtos, mas continua na tabela
+            record_history(db, product, "depleted", "Estoque esgotado")
+            action = "depleted"
+        else:
+            record_history(db, product, "sold", f"Venda de {quantity} unidade(s)")
+            action = "updated"
+        results.append({
+            "product_id": product.id,
+            "description": product.description,
+            "quantity": quantity,
+            "remaining_quantity": product.quantity,
+            "sale_value_brl": sale_row["sale_value_brl"],
+            "sale_value_usd": sale_row["sale_value_usd"],
+            "action": action,
+            "dashboard": product_sale_changes(product)
+        })
+    return results
+
+def process_purchase(db: Session, owner: str, product_id: int, quantity: int) -> dict:
+    product = decrement_stock(db, owner, product_id, quantity)
+    if product is None:
+        db.rollback()
+        exists = db.query(Product.id).filter(
+            Product.id == product_id,
+            Product.owner == owner,
+            Product.deleted_at.is_(None)
+        ).first()
+        if not exists:
+            raise HTTPException(status_code=404, detail="Product not found")
+        raise HTTPException(status_code=400, detail="Not enough stock")
+
+    try:
+        result = record_sales(db, owner, [(product, quantity)])[0]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return result
+
+def process_checkout(db: Session, owner: str, items: List[PurchaseRequest]) -> List[dict]:
+    # Itens repetidos do mesmo produto são somados
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+    stock = dict(
+        db.query(Product.id, Product.quantity)
+        .filter(Product.owner == owner, Product.id.in_(quantities), Product.deleted_at.is_(None))
+        .with_for_update()
+        .all()
+    )
+
+    missing = [product_id for product_id in quantities if product_id not in stock]
+    if missing:
+        db.rollback()
+        raise HTTPException(status_code=404, detail={"message": "Product not found", "product_ids": missing})
+
+    short = [{
+        "product_id": product_id,
+        "requested": quantity,
+        "available": stock[product_id]
+    } for product_id, quantity in quantities.items() if stock[product_id] < quantity]
+    if short:
+        db.rollback()
+        raise HTTPException(status_code=400, detail={"message": "Not enough stock", "items": short})
+
+    try:
+        sold = []
+        for product_id, quantity in quantities.items():
+            product = decrement_stock(db, owner, product_id, quantity)
+            if product is None:
+                # Estoque mudou entre a validação e a baixa: o carrinho inteiro é desfeito
+                db.rollback()
+                raise HTTPException(status_code=409, detail={"message": "Stock changed during checkout", "product_id": product_id})
+            sold.append((product, quantity))
+
+        results = record_sales(db, owner, sold)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return results
+
+async def broadcast_message(message: str, message_type: str = "notification"):
+    await broadcast_bus.publish(None, {
+        "type": message_type,
+        "message": message,
+        "timestamp": datetime.utcnow().isoformat()
+    })
 
 def create_initial_products(db: Session, owner: str):
     if db.query(Product).count() == 0:
+        current_dollar_rate = exchange_rate_service.rate
         initial_products = [
             {
                 "description": "Notebook Dell Inspiron",
@@ -347,6 +2134,9 @@ def create_initial_products(db: Session, owner: str):
         for product_data in initial_products:
             db_product = Product(**product_data)
             db.add(db_product)
+            db.flush()
+            set_product_categories(db, db_product.id, normalize_categories(db_product.categories))
+            record_history(db, db_product, "created", "Initial setup")
         db.commit()
 
 def generate_color_for_category(category_name: str) -> str:
@@ -360,53 +2150,51 @@ def generate_color_for_category(category_name: str) -> str:
     }
     return colors.get(category_name, "#" + "%06x" % (hash(category_name) % 0xFFFFFF))
 
-def cache_response(key_prefix: str, expire: int = CACHE_EXPIRE_SECONDS):
+# Parâmetros de rota que não fazem parte da chave de cache
+CACHE_IGNORED_PARAMS = {"db", "current_user", "response"}
+# Cabeçalhos de resposta guardados junto com o corpo
+CACHED_RESPONSE_HEADERS = (NEXT_CURSOR_HEADER,)
+
+def cache_response(namespace: str, expire: int = CACHE_EXPIRE_SECONDS):
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            cache_key = f"{key_prefix}:{str(kwargs)}"
-            cached_data = redis_client.get(cache_key)
+            if kwargs.get("stream"):
+                # Resposta em streaming: não passa pelo cache
+                return await func(*args, **kwargs)
+
+            owner = kwargs["current_user"].username
+            response = kwargs.get("response")
+            params = {k: v for k, v in kwargs.items() if k not in CACHE_IGNORED_PARAMS}
+
+            cached_data = await response_cache.get(namespace, owner, params)
             if cached_data is not None:
-                return pickle.loads(cached_data)
-            
-            result = await func(*args, **kwargs)
-            redis_client.setex(cache_key, expire, pickle.dumps(result))
-            return result
-        return wrapper
-    return decorator
+                if response is not None:
+                    response.headers.update(cached_data["headers"])
+                return cached_data["data"]
 
-def invalidate_cache(key_prefix: str):
-    def decorator(func):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
+            # Versões lidas antes da consulta: uma invalidação durante o handler
+            # deixa este resultado numa versão já descartada
+            version = await response_cache.version(owner)
             result = await func(*args, **kwargs)
-            keys = redis_client.keys(f"{key_prefix}:*")
-            if keys:
-                redis_client.delete(*keys)
-            
-            if key_prefix == "products":
-                redis_client.delete(*redis_client.keys("dashboard:*"))
-                redis_client.delete(*redis_client.keys("sales:*"))
+            headers = {}
+            if response is not None:
+                headers = {h: response.headers[h] for h in CACHED_RESPONSE_HEADERS if h in response.headers}
+            await response_cache.set(namespace, owner, params, {"data": result, "headers": headers}, expire, version)
             return result
         return wrapper
     return decorator
 
+async def invalidate_cache(owner: Optional[str] = None):
+    await response_cache.invalidate(owner)
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    
-    user = get_user(fake_users_db, username=token_data.username)
+    user = await authenticate_token(token)
     if user is None:
         raise credentials_exception
     return user
@@ -419,15 +2207,24 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
 
 # ===================== Autenticação   =====================
 
+@app.post("/auth/register", response_model=User, status_code=status.HTTP_201_CREATED)
+async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+    hashed_password = await run_password_job(get_password_hash, user.password)
+    created = await run_db(create_user, db, user, hashed_password)
+    invalidate_principal(created.username)
+    return created
+
 @app.post("/auth/login", response_model=Token)
-async def login_for_access_token(login_data: LoginRequest):
-    user = authenticate_user(fake_users_db, login_data.username, login_data.password)
+async def login_for_access_token(login_data: LoginRequest, db: Session = Depends(get_db)):
+    user = await authenticate_user(db, login_data.username, login_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # O login já traz o usuário atualizado do banco
+    cache_principal(user)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
@@ -443,59 +2240,62 @@ async def purchase_product(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    db_product = db.query(Product).filter(
-        Product.id == purchase.product_id,
-        Product.owner == current_user.username
-    ).first()
-    
-    if not db_product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if db_product.quantity < purchase.quantity:
-        raise HTTPException(status_code=400, detail="Not enough stock")
-    
-    # Registrar a venda
-    sale = Sale(
-        product_id=purchase.product_id,
-        quantity=purchase.quantity,
-        sale_value_brl=db_product.price_brl * purchase.quantity,
-        sale_value_usd=db_product.price_usd * purchase.quantity,
-        owner=current_user.username
-    )
-    db.add(sale)
-    
-    # Sincronizar com o dashboard ANTES de atualizar
-    sync_product_to_dashboard(db, db_product)
-    
-    # Atualizar o estoque principal
-    db_product.quantity -= purchase.quantity
-    db_product.status = calculate_status(db_product.quantity, db_product.suggested_quantity)
-    
-    if db_product.quantity <= 0:
-        # Atualiza o dashboard antes de remover
-        update_dashboard_sale(db, sale)
-        db.delete(db_product)
-        message_action = "removed"
-    else:
-        # Atualiza o estoque e o dashboard
-        db.commit()
-        update_dashboard_sale(db, sale)
-        message_action = "updated"
-    
-    # Preparar mensagem para o WebSocket
+    result = await run_db(process_purchase, db, current_user.username, purchase.product_id, purchase.quantity)
+
+    # Preparar mensagem para o WebSocket (agrupada com outras vendas pelo sale_batcher)
     message = {
         "type": "new_sale",
         "data": {
             "product_id": purchase.product_id,
-            "product_description": db_product.description,
+            "product_description": result["description"],
             "quantity": purchase.quantity,
-            "value": db_product.price_brl * purchase.quantity,
-            "action": message_action
+            "value": result["sale_value_brl"],
+            "action": result["action"]
         }
     }
-    
-    await broadcast_dashboard_update(current_user.username, message)
-    return {"message": "Compra realizada com sucesso", "product": db_product.description}
+
+    await invalidate_cache(current_user.username)
+    await sale_batcher.add(current_user.username, message["data"], [result["dashboard"]])
+    return {"message": "Compra realizada com sucesso", "product": result["description"]}
+
+@app.post("/products/checkout/")
+async def checkout_products(
+    checkout: CheckoutRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    results = await run_db(process_checkout, db, current_user.username, checkout.items)
+    total_quantity = sum(r["quantity"] for r in results)
+    total_brl = sum(r["sale_value_brl"] for r in results)
+    total_usd = sum(r["sale_value_usd"] for r in results)
+
+    # Uma única mensagem por carrinho (agrupada com outras vendas pelo sale_batcher)
+    message = {
+        "type": "new_sale",
+        "data": {
+            "product_description": f"Carrinho com {len(results)} produto(s)",
+            "quantity": total_quantity,
+            "value": total_brl,
+            "action": "checkout",
+            "items": [{
+                "product_id": r["product_id"],
+                "product_description": r["description"],
+                "quantity": r["quantity"],
+                "value": r["sale_value_brl"],
+                "action": r["action"]
+            } for r in results]
+        }
+    }
+
+    await invalidate_cache(current_user.username)
+    await sale_batcher.add(current_user.username, message["data"], [r.pop("dashboard") for r in results])
+    return {
+        "message": "Compra realizada com sucesso",
+        "items": results,
+        "total_quantity": total_quantity,
+        "total_brl": total_brl,
+        "total_usd": total_usd
+    }
 
 @app.get("/users/me/", response_model=User)
 async def read_users_me(current_user: User = Depends(get_current_active_user)):
@@ -507,69 +2307,74 @@ async def create_product(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    status = calculate_status(product.quantity, product.suggested_quantity)
-    
-    db_product = Product(
-        description=product.description,
-        image_url=product.image_url,
-        quantity=product.quantity,
-        suggested_quantity=product.suggested_quantity,
-        price_brl=product.price,
-        price_usd=round(product.price / current_dollar_rate, 2),
-        status=status,
-        categories=",".join(product.categories),
-        owner=current_user.username
-    )
-    
-    db.add(db_product)
-    db.commit()
-    db.refresh(db_product)
+    def _create():
+        status = calculate_status(product.quantity, product.suggested_quantity)
+        categories = normalize_categories(product.categories)
+
+        db_product = Product(
+            description=product.description,
+            image_url=product.image_url,
+            quantity=product.quantity,
+            suggested_quantity=product.suggested_quantity,
+            price_brl=product.price,
+            price_usd=round(product.price / exchange_rate_service.rate, 2),
+            status=status,
+            categories=",".join(categories),
+            owner=current_user.username
+        )
+
+        db.add(db_product)
+        db.flush()
+        set_product_categories(db, db_product.id, categories)
+        record_history(db, db_product, "created")
+        db.commit()
+        db.refresh(db_product)
+        return product_response(db_product), product_delta(db_product)
+
+    result, delta = await run_db(_create)
+    await invalidate_cache(current_user.username)
+    await broadcast_dashboard_delta(current_user.username, {"products": [delta]})
     
-    return ProductResponse(
-        id=db_product.id,
-        description=db_product.description,
-        image_url=db_product.image_url,
-        quantity=db_product.quantity,
-        suggested_quantity=db_product.suggested_quantity,
-        price=db_product.price_brl,
-        price_usd=db_product.price_usd,
-        status=db_product.status,
-        categories=db_product.categories.split(","),
-        owner=db_product.owner
-    )
+    return result
 
 @app.get("/products/", response_model=List[ProductResponse])
+@cache_response("products")
 async def get_products(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
     description: Optional[str] = Query(None),
-    categories: Optional[str] = Query(None)
+    categories: Optional[str] = Query(None),
+    limit: int = Query(PAGE_SIZE_DEFAULT, gt=0, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None),
+    stream: bool = Query(False)
 ):
-    query = db.query(Product).filter(Product.owner == current_user.username)
+    def _query():
+        # Paginação por chave (owner, id): o custo não cresce com a profundidade da página
+        query = db.query(Product).filter(Product.owner == current_user.username, product_available())
 
-    if description:
-        query = query.filter(Product.description.ilike(f"%{description}%"))
-    
-    if categories:
-        categories_list = categories.split(",")
-        query = query.filter(Product.categories.in_(categories_list))
-
-    db_products = query.all()
-
-    return [
-        ProductResponse(
-            id=p.id,
-            description=p.description,
-            image_url=p.image_url,
-            quantity=p.quantity,
-            suggested_quantity=p.suggested_quantity,
-            price=p.price_brl,
-            price_usd=p.price_usd,
-            status=p.status,
-            categories=p.categories.split(","),
-            owner=p.owner
-        ) for p in db_products
-    ]
+        if categories:
+            query = query.filter(Product.id.in_(products_in_categories(normalize_categories(categories))))
+
+        if description:
+            # Busca: os `limit` resultados mais relevantes, sem cursor
+            if cursor or stream:
+                raise HTTPException(status_code=400, detail="Cursor pagination and streaming are not available for search results")
+            db_products = apply_product_search(query, description).limit(limit).all()
+            return [product_response(p) for p in db_products]
+
+        if cursor:
+            last_id, = decode_cursor(cursor, 1)
+            query = query.filter(Product.id > last_id)
+
+        if stream:
+            return stream_response(query.order_by(Product.id), Product, product_export_row)
+
+        db_products = query.order_by(Product.id).limit(limit).all()
+        set_next_cursor(response, db_products, limit, lambda p: [p.id])
+        return [product_response(p) for p in db_products]
+
+    return await run_db(_query)
 
 @app.put("/products/{product_id}", response_model=ProductResponse)
 async def update_product(
@@ -578,27 +2383,42 @@ async def update_product(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    db_product = db.query(Product).filter(
-        Product.id == product_id,
-        Product.owner == current_user.username
-    ).first()
-    
-    if not db_product:
-        raise HTTPException(status_code=404, detail="Product not found")
-
-    db_product.description = product.description
-    db_product.image_url = product.image_url
-    db_product.quantity = product.quantity
-    db_product.suggested_quantity = product.suggested_quantity
-    db_product.price_brl = product.price
-    db_product.price_usd = round(product.price / current_dollar_rate, 2)
-    db_product.status = calculate_status(product.quantity, product.suggested_quantity)
-    db_product.categories = ",".join(product.categories)
-    
-    db.commit()
-    db.refresh(db_product)
+    def _update():
+        db_product = db.query(Product).filter(
+            Product.id == product_id,
+            Product.owner == current_user.username,
+            Product.deleted_at.is_(None)
+        ).first()
+
+        if not db_product:
+            raise HTTPException(status_code=404, detail="Product not found")
+
+        db_product.description = product.description
+        db_product.image_url = product.image_url
+        db_product.quantity = product.quantity
+        db_product.suggested_quantity = product.suggested_quantity
+        db_product.price_brl = product.price
+        db_product.price_usd = round(product.price / exchange_rate_service.rate, 2)
+        db_product.status = calculate_status(product.quantity, product.suggested_quantity)
+        categories = normalize_categories(product.categories)
+        db_product.categories = ",".join(categories)
+        db_product.last_update = datetime.utcnow().isoformat()
+        set_product_categories(db, db_product.id, categories)
+        record_history(db, db_product, "updated")
+        db.query(ProductSalesTotal).filter(
+            ProductSalesTotal.owner == current_user.username,
+            ProductSalesTotal.product_id == db_product.id
+        ).update({"description": db_product.description}, synchronize_session=False)
+
+        db.commit()
+        db.refresh(db_product)
+        return product_response(db_product), product_delta(db_product)
+
+    result, delta = await run_db(_update)
+    await invalidate_cache(current_user.username)
+    await broadcast_dashboard_delta(current_user.username, {"products": [delta]})
     
-    return db_product
+    return result
 
 @app.delete("/products/{product_id}", response_model=ProductResponse)
 async def delete_product(
@@ -606,132 +2426,87 @@ async def delete_product(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    db_product = db.query(Product).filter(
-        Product.id == product_id,
-        Product.owner == current_user.username
-    ).first()
-    
-    if not db_product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    db.delete(db_product)
-    db.commit()
-    
-    return db_product
-
-@app.post("/products/purchase/")
-async def purchase_product(
-    purchase: PurchaseRequest,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
-):
-    db_product = db.query(Product).filter(
-        Product.id == purchase.product_id,
-        Product.owner == current_user.username
-    ).first()
-    
-    if not db_product:
-        raise HTTPException(status_code=404, detail="Product not found")
-    
-    if db_product.quantity < purchase.quantity:
-        raise HTTPException(status_code=400, detail="Not enough stock")
-    
-    # Registrar a venda
-    sale = Sale(
-        product_id=purchase.product_id,
-        quantity=purchase.quantity,
-        sale_value_brl=db_product.price_brl * purchase.quantity,
-        sale_value_usd=db_product.price_usd * purchase.quantity,
-        owner=current_user.username
-    )
-    db.add(sale)
-    
-    # Atualizar o estoque
-    db_product.quantity -= purchase.quantity
-    db_product.status = calculate_status(db_product.quantity, db_product.suggested_quantity)
-    
-    if db_product.quantity <= 0:
-        db.delete(db_product)
+    def _delete():
+        db_product = db.query(Product).filter(
+            Product.id == product_id,
+            Product.owner == current_user.username,
+            Product.deleted_at.is_(None)
+        ).first()
+
+        if not db_product:
+            raise HTTPException(status_code=404, detail="Product not found")
+
+        # Exclusão lógica: vendas e categorias continuam ligadas ao produto
+        db_product.deleted_at = db_product.last_update = datetime.utcnow().isoformat()
+        record_history(db, db_product, "deleted")
         db.commit()
-        message = f"Produto {db_product.description} comprado e removido do estoque."
-    else:
-        db.commit()
-        message = f"Produto {db_product.description} comprado com sucesso!"
+        return product_response(db_product), product_delta(db_product)
+
+    result, delta = await run_db(_delete)
+    await invalidate_cache(current_user.username)
+    await broadcast_dashboard_delta(current_user.username, {"products": [delta]})
     
-    await broadcast_message(message)
-    return {"message": message}
+    return result
 
 @app.get("/top-products/")
+@cache_response("top-products")
 async def get_top_products(
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_active_user)
+    current_user: User = Depends(get_current_active_user),
+    metric: LeaderboardMetric = LeaderboardMetric.quantity,
+    days: Optional[int] = Query(None, gt=0, le=366),
+    limit: int = Query(10, gt=0, le=100)
 ):
-    top_products = (
-        db.query(
-            Product.description,
-            func.sum(Sale.quantity).label('total_sales'),
-            func.sum(Sale.sale_value_brl).label('total_revenue')
-        )
-        .join(Sale, Sale.product_id == Product.id)
-        .filter(Sale.owner == current_user.username)
-        .group_by(Product.description)
-        .order_by(func.sum(Sale.quantity).desc())
-        .limit(10)
-        .all()
+    return await run_analytics(
+        top_products_leaderboard, db, current_user.username, metric, days, limit
     )
-    
-    return [{
-        "name": product[0], 
-        "sales": product[1],
-        "revenue": product[2]
-    } for product in top_products]
 
 @app.get("/sales-trend/")
+@cache_response("sales-trend")
 async def get_sales_trend(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
     start_date: str = Query(None),
     end_date: str = Query(None)
 ):
-    # Filtro básico - você pode melhorar isso
-    sales = (
-        db.query(Sale)
-        .filter(Sale.owner == current_user.username)
-        .order_by(Sale.sale_date)
-        .all()
+    # Lido do rollup diário; o filtro de datas é feito no banco
+    query = (
+        db.query(SalesDaily.day, func.sum(SalesDaily.revenue_brl))
+        .filter(SalesDaily.owner == current_user.username)
     )
-    
-    # Agrupar por dia (simplificado)
-    daily_sales = {}
-    for sale in sales:
-        sale_date = datetime.fromisoformat(sale.sale_date).date()
-        if sale_date not in daily_sales:
-            daily_sales[sale_date] = 0
-        daily_sales[sale_date] += sale.sale_value_brl
-    
+    if start_date:
+        query = query.filter(SalesDaily.day >= start_date[:10])
+    if end_date:
+        query = query.filter(SalesDaily.day <= end_date[:10])
+
+    daily_sales = await run_analytics(query.group_by(SalesDaily.day).order_by(SalesDaily.day).all)
+
     # Converter para o formato esperado pelo frontend
     trend_data = [{
-        "date": date.isoformat(),
+        "date": day,
         "total": total
-    } for date, total in daily_sales.items()]
+    } for day, total in daily_sales]
     
     return trend_data
 
 @app.get("/sales-by-category/")
+@cache_response("sales-by-category")
 async def get_sales_by_category(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
     start_date: str = Query(None),
     end_date: str = Query(None)
 ):
-    # Implementação melhorada
+    # Join indexado pela associação: uma venda conta em todas as categorias do produto
     query = (
         db.query(
-            Product.categories,
+            Category.name,
             func.sum(Sale.quantity).label('total_quantity'),
             func.sum(Sale.sale_value_brl).label('total_revenue')
         )
-        .join(Sale, Sale.product_id == Product.id)
+        .select_from(Sale)
+        .join(ProductCategory, ProductCategory.product_id == Sale.product_id)
+        .join(Category, Category.id == ProductCategory.category_id)
         .filter(Sale.owner == current_user.username)
     )
     
@@ -740,35 +2515,47 @@ async def get_sales_by_category(
     if end_date:
         query = query.filter(Sale.sale_date <= end_date)
     
-    results = query.group_by(Product.categories).all()
-    
-    categories = []
-    for cat, qty, revenue in results:
-        if cat:
-            categories.append({
-                "name": cat.split(',')[0],  # Pega a primeira categoria
-                "sales": qty,
-                "revenue": revenue,
-                "color": generate_color_for_category(cat)
-            })
+    results = await run_analytics(query.group_by(Category.name).all)
     
-    return categories
+    return [{
+        "name": cat,
+        "sales": qty,
+        "revenue": revenue,
+        "color": generate_color_for_category(cat)
+    } for cat, qty, revenue in results]
 
 @app.get("/sales-history/", response_model=List[SaleResponse])
 async def get_sales_history(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
-    limit: int = Query(100, gt=0, le=1000),
-    offset: int = Query(0, ge=0)
+    limit: int = Query(PAGE_SIZE_DEFAULT, gt=0, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    offset: int = Query(0, ge=0, deprecated=True),
+    stream: bool = Query(False)
 ):
-    sales = (
-        db.query(Sale)
-        .filter(Sale.owner == current_user.username)
-        .order_by(Sale.sale_date.desc())
-        .offset(offset)
-        .limit(limit)
-        .all()
-    )
+    # Ordenação (sale_date, id) decrescente, coberta pelo índice (owner, sale_date, id)
+    query = db.query(Sale).filter(Sale.owner == current_user.username)
+
+    if start_date:
+        query = query.filter(Sale.sale_date >= start_date)
+    if end_date:
+        query = query.filter(Sale.sale_date <= end_date)
+
+    query = query.order_by(Sale.sale_date.desc(), Sale.id.desc())
+    if cursor:
+        last_date, last_id = decode_cursor(cursor, 2)
+        query = query.filter(tuple_(Sale.sale_date, Sale.id) < tuple_(last_date, last_id))
+    elif offset:
+        query = query.offset(offset)
+
+    if stream:
+        return stream_response(query, Sale, sale_export_row)
+
+    sales = await run_db(query.limit(limit).all)
+    set_next_cursor(response, sales, limit, lambda s: [s.sale_date, s.id])
     
     return sales
 
@@ -777,56 +2564,108 @@ async def reset_sales(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    db.query(Sale).filter(Sale.owner == current_user.username).delete()
-    db.commit()
+    def _reset():
+        db.query(Sale).filter(Sale.owner == current_user.username).delete()
+        db.query(SalesDaily).filter(SalesDaily.owner == current_user.username).delete()
+        db.query(ProductSalesTotal).filter(ProductSalesTotal.owner == current_user.username).delete()
+        db.commit()
+
+    await run_db(_reset)
+    await invalidate_cache(current_user.username)
     return {"message": "Todas as vendas foram removidas com sucesso."}
 
 @app.get("/categories/")
+@cache_response("categories")
 async def get_categories(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    results = db.query(Product.categories).filter(Product.owner == current_user.username).all()
-    category_set = set()
-    for row in results:
-        if row[0]:
-            categories = [cat.strip() for cat in row[0].split(',')]
-            category_set.update(categories)
-    return sorted(category_set)
+    results = await run_db(
+        db.query(Category.name)
+        .join(ProductCategory, ProductCategory.category_id == Category.id)
+        .join(Product, Product.id == ProductCategory.product_id)
+        .filter(Product.owner == current_user.username, product_available())
+        .distinct()
+        .order_by(Category.name)
+        .all
+    )
+    return [name for name, in results]
 
 @app.post("/update_dollar_rate/")
 async def update_dollar_rate(
-    new_rate: float,
+    new_rate: float = Query(..., gt=0),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    global current_dollar_rate
-    current_dollar_rate = new_rate
-    update_product_prices(db)
+    exchange_rate_service.set_rate(new_rate)
+    updated = await run_db(update_product_prices, db, new_rate)
+    await invalidate_cache()
     await broadcast_message(f"Novo valor do dólar: {new_rate}")
-    return {"message": "Dollar rate updated", "new_rate": new_rate}
+    await broadcast_dashboard_delta(None, {"exchange_rate": exchange_rate_response()})
+    return {"message": "Dollar rate updated", "new_rate": new_rate, "updated": updated}
+
+@app.delete("/update_dollar_rate/")
+async def clear_manual_dollar_rate(current_user: User = Depends(get_current_active_user)):
+    # Retira a cotação manual: volta a valer a do provedor (já, se houver leitura)
+    rate = exchange_rate_service.clear_manual_rate()
+    if rate is not None:
+        await reprice_on_rate_change(rate)
+    return {"message": "Manual dollar rate cleared", "rate": exchange_rate_service.rate}
+
+@app.get("/cache/stats/")
+async def get_cache_stats(current_user: User = Depends(get_current_active_user)):
+    return {**response_cache.stats(), "auth": auth_stats()}
+
+@app.get("/dashboard-ws/stats/")
+async def get_dashboard_ws_stats(current_user: User = Depends(get_current_active_user)):
+    return {"hub": dashboard_hub.stats(), "bus": broadcast_bus.stats(), "sale_batches": sale_batcher.stats()}
+
+@app.get("/dollar_rate/")
+async def get_dollar_rate(current_user: User = Depends(get_current_active_user)):
+    return {
+        **exchange_rate_response(),
+        "manual": exchange_rate_service.manual,
+        "provider_rate": exchange_rate_service.provider_snapshot.rate if exchange_rate_service.provider_snapshot else None,
+        "consecutive_failures": exchange_rate_service.failures,
+        "last_error": exchange_rate_service.last_error
+    }
 
 @app.get("/products/history/", response_model=List[dict])
 async def get_products_history(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
     product_id: Optional[int] = None,
     action: Optional[str] = None,
-    limit: int = 100
+    limit: int = Query(PAGE_SIZE_DEFAULT, gt=0, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None),
+    stream: bool = Query(False)
 ):
     query = db.query(ProductHistory).filter(
         ProductHistory.owner == current_user.username
-    ).order_by(ProductHistory.action_date.desc())
+    )
     
     if product_id:
         query = query.filter(ProductHistory.original_id == product_id)
     
     if action:
         query = query.filter(ProductHistory.action == action)
+
+    if cursor:
+        last_date, last_id = decode_cursor(cursor, 2)
+        query = query.filter(tuple_(ProductHistory.action_date, ProductHistory.id) < tuple_(last_date, last_id))
+
+    query = query.order_by(ProductHistory.action_date.desc(), ProductHistory.id.desc())
+    if stream:
+        return stream_response(query, ProductHistory, history_response)
+
+    history = await run_db(query.limit(limit).all)
+    set_next_cursor(response, history, limit, lambda h: [h.action_date, h.id])
     
-    history = query.limit(limit).all()
-    
-    return [{
+    return [history_response(h) for h in history]
+
+def history_response(h) -> dict:
+    return {
         "id": h.id,
         "original_id": h.original_id,
         "description": h.description,
@@ -836,7 +2675,223 @@ async def get_products_history(
         "quantity": h.quantity,
         "price_brl": h.price_brl,
         "status": h.status
-    } for h in history]
+    }
+
+
+# ===================== IMPORTAÇÃO E EXPORTAÇÃO =====================
+
+DATA_FORMAT_EXTENSIONS = {".csv": DataFormat.csv, ".ndjson": DataFormat.ndjson, ".jsonl": DataFormat.ndjson}
+DATA_FORMAT_MEDIA_TYPES = {DataFormat.csv: "text/csv", DataFormat.ndjson: "application/x-ndjson"}
+
+def guess_data_format(filename: Optional[str], content_type: Optional[str]) -> Optional[DataFormat]:
+    for media_format, media_type in DATA_FORMAT_MEDIA_TYPES.items():
+        if content_type == media_type:
+            return media_format
+    return DATA_FORMAT_EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+
+def iter_import_rows(stream, data_format: DataFormat):
+    # Lê o arquivo linha a linha: gera (linha, dict) ou (linha, mensagem de erro)
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    if data_format == DataFormat.csv:
+        reader = csv.DictReader(text_stream)
+        try:
+            for row in reader:
+                row.pop(None, None)  # colunas a mais que o cabeçalho
+                yield reader.line_num, row
+        except csv.Error as e:
+            yield reader.line_num, f"Invalid CSV: {e}"
+        return
+
+    for line_number, line in enumerate(text_stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_number, "Invalid JSON"
+            continue
+        yield line_number, row if isinstance(row, dict) else "Expected a JSON object"
+
+def insert_product_batch(db: Session, owner: str, products: List[ProductCreate]) -> list:
+    # Um INSERT em lote (com os ids via RETURNING), as associações de categoria
+    # e o histórico no mesmo commit; nada fica carregado na sessão. Devolve as
+    # linhas gravadas (com id).
+    now = datetime.utcnow().isoformat()
+    rate = exchange_rate_service.rate
+    names = [normalize_categories(product.categories) for product in products]
+    rows = [{
+        "description": product.description,
+        "image_url": product.image_url,
+        "quantity": product.quantity,
+        "suggested_quantity": product.suggested_quantity,
+        "price_brl": product.price,
+        "price_usd": round(product.price / rate, 2),
+        "status": calculate_status(product.quantity, product.suggested_quantity),
+        "categories": ",".join(categories),
+        "owner": owner,
+        "sold_quantity": 0,
+        "last_update": now,
+        "deleted_at": None
+    } for product, categories in zip(products, names)]
+
+    ids = db.execute(insert(Product).returning(Product.id, sort_by_parameter_order=True), rows).scalars().all()
+
+    category_ids = get_category_ids(db, sorted({name for categories in names for name in categories}))
+    links = [
+        {"product_id": product_id, "category_id": category_ids[name]}
+        for product_id, categories in zip(ids, names)
+        for name in categories
+    ]
+    if links:
+        db.execute(insert(ProductCategory), links)
+
+    inserted = [SimpleNamespace(id=product_id, **row) for product_id, row in zip(ids, rows)]
+    for product in inserted:
+        record_history(db, product, "created", "Import")
+    db.commit()
+    return inserted
+
+def import_products(db: Session, owner: str, stream, data_format: DataFormat, on_batch=None) -> dict:
+    # Cada bloco de IMPORT_BATCH_SIZE linhas válidas é gravado e confirmado; as
+    # linhas inválidas são puladas e reportadas com o número da linha.
+    # on_batch(produtos) é chamado depois do commit de cada bloco.
+    report = {"imported": 0, "failed": 0, "errors": []}
+    batch = []
+
+    def write_batch():
+        inserted = insert_product_batch(db, owner, batch)
+        report["imported"] += len(inserted)
+        if on_batch is not None:
+            on_batch(inserted)
+
+    for line_number, row in iter_import_rows(stream, data_format):
+        if isinstance(row, dict):
+            if isinstance(row.get("categories"), str):
+                row["categories"] = normalize_categories(row["categories"])
+            try:
+                batch.append(ProductCreate.model_validate(row))
+            except ValidationError as e:
+                messages = [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()]
+            else:
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    write_batch()
+                    batch = []
+                continue
+        else:
+            messages = [row]
+
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"line": line_number, "errors": messages})
+
+    if batch:
+        write_batch()
+    return report
+
+def export_rows(statement, data_format: DataFormat, fields: List[str], convert):
+    # Gerador da resposta: lê em blocos de EXPORT_BATCH_SIZE (cursor no servidor
+    # no Postgres) e codifica bloco a bloco. Abre a própria sessão, porque a do
+    # Depends(get_db) é fechada antes de o corpo começar a ser enviado.
+    db = SessionLocal()
+    try:
+        result = db.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        if data_format == DataFormat.csv:
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            for partition in result.partitions():
+                for row in partition:
+                    writer.writerow({
+                        key: ",".join(value) if isinstance(value, list) else value
+                        for key, value in convert(row).items()
+                    })
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue()  # só o cabeçalho: nenhuma linha
+        else:
+            for partition in result.partitions():
+                yield "".join(json.dumps(convert(row)) + "\n" for row in partition)
+    finally:
+        db.close()
+
+def export_response(statement, data_format: DataFormat, fields: List[str], convert, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        export_rows(statement, data_format, fields, convert),
+        media_type=DATA_FORMAT_MEDIA_TYPES[data_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{data_format.value}"'}
+    )
+
+def stream_response(query, model, convert) -> StreamingResponse:
+    # Modo ?stream=true das listagens: NDJSON com todas as linhas a partir do
+    # cursor (sem `limit`), lidas como colunas, sem carregar objetos do ORM
+    statement = query.with_entities(*model.__table__.columns).statement
+    return StreamingResponse(
+        export_rows(statement, DataFormat.ndjson, [], convert),
+        media_type=DATA_FORMAT_MEDIA_TYPES[DataFormat.ndjson]
+    )
+
+def product_export_row(row) -> dict:
+    # Mesmo formato de GET /products/, que também é o aceito pela importação
+    return product_response(row).model_dump(mode="json")
+
+def sale_export_row(row) -> dict:
+    return dict(row._mapping)
+
+@app.post("/products/import/")
+async def import_products_file(
+    file: UploadFile = File(...),
+    format: Optional[DataFormat] = Query(None),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    data_format = format or guess_data_format(file.filename, file.content_type)
+    if data_format is None:
+        raise HTTPException(status_code=400, detail="Unknown file format, use ?format=csv or ?format=ndjson")
+
+    # Cada bloco confirmado vira um delta do dashboard; a importação roda numa
+    # thread do db_executor, então o envio é agendado no event loop
+    loop = asyncio.get_running_loop()
+
+    def publish_batch(products):
+        asyncio.run_coroutine_threadsafe(
+            broadcast_dashboard_delta(current_user.username, {"products": [product_delta(p) for p in products]}),
+            loop
+        )
+
+    try:
+        return await run_db(import_products, db, current_user.username, file.file, data_format, publish_batch)
+    finally:
+        # Os blocos já confirmados ficam mesmo se a importação parar no meio
+        await invalidate_cache(current_user.username)
+
+@app.get("/products/export/")
+async def export_products(
+    current_user: User = Depends(get_current_active_user),
+    format: DataFormat = Query(DataFormat.csv)
+):
+    statement = (
+        select(*Product.__table__.columns)
+        .where(Product.owner == current_user.username, Product.deleted_at.is_(None))
+        .order_by(Product.id)
+    )
+    return export_response(statement, format, list(ProductResponse.model_fields), product_export_row, "products")
+
+@app.get("/sales-history/export/")
+async def export_sales_history(
+    current_user: User = Depends(get_current_active_user),
+    format: DataFormat = Query(DataFormat.csv),
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None)
+):
+    statement = select(*Sale.__table__.columns).where(Sale.owner == current_user.username)
+    if start_date:
+        statement = statement.where(Sale.sale_date >= start_date)
+    if end_date:
+        statement = statement.where(Sale.sale_date <= end_date)
+    statement = statement.order_by(Sale.sale_date.desc(), Sale.id.desc())
+    return export_response(statement, format, list(SaleResponse.model_fields), sale_export_row, "sales")
 
 
 # ===================== DASHBOARD =====================
@@ -851,175 +2906,569 @@ async def dashboard_websocket(websocket: WebSocket):
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             return
             
-        try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username = payload.get("sub")
-            if not username or username not in fake_users_db:
-                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
-                return
-        except JWTError as e:
-            print(f"JWT Error: {e}")
+        user = await authenticate_token(token)
+        if user is None or user.disabled:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             return
+        username = user.username
         
-        # Adiciona a conexão à lista específica do dashboard
-        if username not in active_connections_ws2:
-            active_connections_ws2[username] = []
-        active_connections_ws2[username].append(websocket)
+        protocol = int(websocket.query_params.get("protocol", 1))
+        heartbeat = websocket.query_params.get("heartbeat") == "1"
+        connection = dashboard_hub.register(websocket, username, protocol, heartbeat)
         
         try:
+            if protocol >= 2:
+                last_seq = websocket.query_params.get("last_seq")
+                last_seq = int(last_seq) if last_seq is not None else None
+                if not dashboard_hub.resume(connection, websocket.query_params.get("epoch"), last_seq):
+                    # Deltas que chegarem enquanto o snapshot é montado ficam na fila
+                    # com seq maior que a do snapshot
+                    seq = dashboard_hub.current_seq(username)
+                    await send_dashboard_snapshot(websocket, username, seq)
+            connection.start()
+
             while True:
-                # Manter conexão aberta
+                # Manter conexão aberta; o cliente responde aos pings com "pong"
                 data = await websocket.receive_text()
-                print(f"Message received: {data}")
+                try:
+                    kind = json.loads(data).get("type") if data.startswith("{") else data
+                except ValueError:
+                    kind = None
+                if kind == "pong":
+                    connection.pong()
         except WebSocketDisconnect:
-            print("Client disconnected")
+            pass
         finally:
-            if username in active_connections_ws2:
-                active_connections_ws2[username].remove(websocket)
-                if not active_connections_ws2[username]:
-                    del active_connections_ws2[username]
+            await dashboard_hub.unregister(connection)
     except Exception as e:
         print(f"WebSocket error: {e}")
         await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
 
 @app.get("/dashboard/products/", response_model=List[dict])
 async def get_dashboard_products(
+    response: Response,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
-    show_inactive: bool = False
+    show_inactive: bool = False,
+    limit: int = Query(PAGE_SIZE_DEFAULT, gt=0, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None),
+    stream: bool = Query(False)
 ):
-    query = db.query(DashboardProduct).filter(
-        DashboardProduct.owner == current_user.username
+    # show_inactive inclui os esgotados; excluídos nunca aparecem
+    query = db.query(Product).filter(
+        Product.owner == current_user.username,
+        Product.deleted_at.is_(None)
     )
     
     if not show_inactive:
-        query = query.filter(DashboardProduct.is_active == 1)
-    
-    products = query.order_by(DashboardProduct.last_update.desc()).all()
+        query = query.filter(product_available())
+
+    if cursor:
+        last_update, last_id = decode_cursor(cursor, 2)
+        query = query.filter(tuple_(Product.last_update, Product.id) < tuple_(last_update, last_id))
+
+    query = query.order_by(Product.last_update.desc(), Product.id.desc())
+    if stream:
+        return stream_response(query, Product, dashboard_product_response)
+
+    products = await run_db(query.limit(limit).all)
+    set_next_cursor(response, products, limit, lambda p: [p.last_update, p.id])
     
-    return [{
-        "id": p.id,
-        "original_id": p.original_id,
-        "description": p.description,
-        "image_url": p.image_url,
-        "initial_quantity": p.initial_quantity,
-        "sold_quantity": p.sold_quantity,
-        "current_quantity": p.current_quantity,
-        "suggested_quantity": p.suggested_quantity,
-        "price_brl": p.price_brl,
-        "price_usd": p.price_usd,
-        "status": p.status,
-        "categories": p.categories.split(",") if p.categories else [],
-        "last_update": p.last_update,
-        "is_active": bool(p.is_active)
-    } for p in products]
+    return [dashboard_product_response(p) for p in products]
 
 @app.get("/dashboard/sales-analytics/")
+@cache_response("sales-analytics")
 async def get_sales_analytics(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
-    period: str = "month"  # day, week, month, year
+    period: AnalyticsPeriod = AnalyticsPeriod.month,
+    start_date: Optional[str] = Query(None),
+    end_date: Optional[str] = Query(None),
+    group_by: Optional[AnalyticsBreakdown] = Query(None)
 ):
-    # Implementação da análise de vendas por período
-    pass
+    # Aceita AAAA, AAAA-MM, AAAA-MM-DD ou data/hora ISO
+    start_day = parse_analytics_day(start_date)
+    end_day = parse_analytics_day(end_date, end=True)
+
+    return await run_analytics(
+        compute_sales_analytics, db, current_user.username, period, start_day, end_day, group_by
+    )
+
+def compute_sales_analytics(
+    db: Session,
+    owner: str,
+    period: AnalyticsPeriod,
+    start_day: Optional[str],
+    end_day: Optional[str],
+    group_by: Optional[AnalyticsBreakdown]
+):
+    buckets = {
+        row.bucket: {
+            "bucket": row.bucket,
+            "quantity": row.quantity,
+            "revenue_brl": row.revenue_brl,
+            "revenue_usd": row.revenue_usd,
+            "breakdown": {}
+        } for row in sales_analytics_rows(db, owner, period, start_day, end_day, None)
+    }
+
+    # O detalhamento é uma segunda agregação: um produto em várias categorias
+    # aparece em cada uma delas sem inflar o total do bucket
+    breakdown_rows = []
+    if group_by is not None:
+        breakdown_rows = sales_analytics_rows(db, owner, period, start_day, end_day, group_by)
+        for row in breakdown_rows:
+            add_analytics_breakdown(buckets[row.bucket]["breakdown"], group_by, row)
+
+    if group_by == AnalyticsBreakdown.product:
+        # Nomes dos produtos numa única consulta
+        product_ids = {row.key for row in breakdown_rows}
+        names = dict(db.query(Product.id, Product.description).filter(Product.id.in_(product_ids)).all())
+        for bucket in buckets.values():
+            for item in bucket["breakdown"].values():
+                item["name"] = names.get(item["key"], f"Produto #{item['key']}")
+
+    # Série completa, com zeros nos períodos sem vendas: cada bucket é comparado
+    # com o período imediatamente anterior (o primeiro fica sem comparação)
+    first = date.fromisoformat(start_day) if start_day else (bucket_day(min(buckets), period) if buckets else None)
+    last = date.fromisoformat(end_day) if end_day else (bucket_day(max(buckets), period) if buckets else None)
+    labels = analytics_bucket_labels(period, first, last) if first and last else []
+
+    previous = None
+    result = []
+    for key in labels:
+        bucket = buckets.get(key) or {
+            "bucket": key, "quantity": 0, "revenue_brl": 0.0, "revenue_usd": 0.0, "breakdown": {}
+        }
+        bucket.update(analytics_change(bucket, previous))
+        if group_by is None:
+            del bucket["breakdown"]
+        else:
+            bucket["breakdown"] = sorted(bucket["breakdown"].values(), key=lambda b: b["revenue_brl"], reverse=True)
+        result.append(bucket)
+        previous = bucket
+
+    totals = analytics_totals(result)
+    response = {
+        "period": period.value,
+        "start_date": start_day,
+        "end_date": end_day,
+        "group_by": group_by.value if group_by else None,
+        "buckets": result,
+        "totals": totals,
+        "previous_totals": None
+    }
+
+    # Comparação com o intervalo imediatamente anterior, de mesmo tamanho
+    if start_day and end_day:
+        start = datetime.fromisoformat(start_day).date()
+        end = datetime.fromisoformat(end_day).date()
+        previous_end = start - timedelta(days=1)
+        previous_start = previous_end - (end - start)
+        previous_rows = sales_analytics_rows(
+            db, owner, period, previous_start.isoformat(), previous_end.isoformat(), None
+        )
+        previous_totals = analytics_totals(previous_rows)
+        response["previous_totals"] = previous_totals
+        response["totals"].update(analytics_change(totals, previous_totals))
+
+    return response
+
+def parse_analytics_day(value: Optional[str], end: bool = False) -> Optional[str]:
+    # AAAA e AAAA-MM valem pelo primeiro dia (início do intervalo) ou pelo
+    # último (fim); entradas inválidas viram 422
+    if not value:
+        return None
+    try:
+        if re.fullmatch(r"\d{4}", value):
+            day = date(int(value), 12, 31) if end else date(int(value), 1, 1)
+        elif re.fullmatch(r"\d{4}-\d{2}", value):
+            day = date.fromisoformat(f"{value}-01")
+            if end:
+                day = next_bucket(day, AnalyticsPeriod.month) - timedelta(days=1)
+        else:
+            day = datetime.fromisoformat(value).date()
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid date: {value}")
+    return day.isoformat()
+
+def bucket_start(day: date, period: AnalyticsPeriod) -> date:
+    # Mesmos buckets de period_bucket, calculados em Python
+    if period == AnalyticsPeriod.year:
+        return date(day.year, 1, 1)
+    if period == AnalyticsPeriod.month:
+        return day.replace(day=1)
+    if period == AnalyticsPeriod.week:
+        return day - timedelta(days=day.weekday())
+    return day
+
+def next_bucket(day: date, period: AnalyticsPeriod) -> date:
+    if period == AnalyticsPeriod.year:
+        return date(day.year + 1, 1, 1)
+    if period == AnalyticsPeriod.month:
+        return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    if period == AnalyticsPeriod.week:
+        return day + timedelta(days=7)
+    return day + timedelta(days=1)
+
+def bucket_label(day: date, period: AnalyticsPeriod) -> str:
+    if period == AnalyticsPeriod.year:
+        return f"{day.year:04d}"
+    if period == AnalyticsPeriod.month:
+        return day.isoformat()[:7]
+    return day.isoformat()
+
+def bucket_day(label: str, period: AnalyticsPeriod) -> date:
+    if period == AnalyticsPeriod.year:
+        return date(int(label), 1, 1)
+    if period == AnalyticsPeriod.month:
+        return date.fromisoformat(f"{label}-01")
+    return date.fromisoformat(label)
+
+def analytics_bucket_labels(period: AnalyticsPeriod, first: date, last: date) -> List[str]:
+    labels = []
+    day = bucket_start(first, period)
+    while day <= last:
+        if len(labels) >= ANALYTICS_MAX_BUCKETS:
+            raise HTTPException(status_code=422, detail="Date range too large for this period")
+        labels.append(bucket_label(day, period))
+        day = next_bucket(day, period)
+    return labels
+
+def period_bucket(day_column, period: AnalyticsPeriod):
+    # Rótulo do bucket calculado pelo banco a partir do dia (YYYY-MM-DD).
+    # Semanas são rotuladas pela segunda-feira em que começam.
+    if period == AnalyticsPeriod.year:
+        return func.substr(day_column, 1, 4)
+    if period == AnalyticsPeriod.month:
+        return func.substr(day_column, 1, 7)
+    if period == AnalyticsPeriod.week:
+        if engine.dialect.name == "postgresql":
+            return func.to_char(func.date_trunc("week", cast(day_column, Date)), "YYYY-MM-DD")
+        return func.date(day_column, "-6 days", "weekday 1")
+    return day_column
+
+def sales_analytics_rows(
+    db: Session,
+    owner: str,
+    period: AnalyticsPeriod,
+    start_day: Optional[str],
+    end_day: Optional[str],
+    group_by: Optional[AnalyticsBreakdown]
+):
+    bucket = period_bucket(SalesDaily.day, period).label("bucket")
+    columns = [
+        bucket,
+        func.sum(SalesDaily.quantity).label("quantity"),
+        func.sum(SalesDaily.revenue_brl).label("revenue_brl"),
+        func.sum(SalesDaily.revenue_usd).label("revenue_usd")
+    ]
+    group_columns = [bucket]
+    if group_by == AnalyticsBreakdown.category:
+        category_name = func.coalesce(Category.name, "Sem categoria")
+        columns.append(category_name.label("key"))
+        group_columns.append(category_name)
+    elif group_by == AnalyticsBreakdown.product:
+        columns.append(SalesDaily.product_id.label("key"))
+        group_columns.append(SalesDaily.product_id)
+
+    query = db.query(*columns).filter(SalesDaily.owner == owner)
+    if group_by == AnalyticsBreakdown.category:
+        # Um produto em várias categorias conta integralmente em cada uma delas
+        query = (
+            query
+            .outerjoin(ProductCategory, ProductCategory.product_id == SalesDaily.product_id)
+            .outerjoin(Category, Category.id == ProductCategory.category_id)
+        )
+    if start_day:
+        query = query.filter(SalesDaily.day >= start_day)
+    if end_day:
+        query = query.filter(SalesDaily.day <= end_day)
+    return query.group_by(*group_columns).all()
+
+def add_analytics_breakdown(breakdown: dict, group_by: AnalyticsBreakdown, row):
+    item = breakdown.setdefault(row.key, {
+        "key": row.key,
+        "name": row.key if group_by == AnalyticsBreakdown.category else None,
+        "quantity": 0,
+        "revenue_brl": 0.0,
+        "revenue_usd": 0.0
+    })
+    item["quantity"] += row.quantity
+    item["revenue_brl"] += row.revenue_brl
+    item["revenue_usd"] += row.revenue_usd
+
+def analytics_totals(rows) -> dict:
+    return {
+        "quantity": sum(_analytics_value(r, "quantity") for r in rows),
+        "revenue_brl": sum(_analytics_value(r, "revenue_brl") for r in rows),
+        "revenue_usd": sum(_analytics_value(r, "revenue_usd") for r in rows)
+    }
+
+def _analytics_value(row, field: str):
+    return (row[field] if isinstance(row, dict) else getattr(row, field)) or 0
+
+def analytics_change(current: dict, previous: Optional[dict]) -> dict:
+    if previous is None:
+        return {"delta_quantity": None, "delta_revenue_brl": None, "delta_revenue_pct": None}
+    delta_revenue = current["revenue_brl"] - previous["revenue_brl"]
+    return {
+        "delta_quantity": current["quantity"] - previous["quantity"],
+        "delta_revenue_brl": delta_revenue,
+        "delta_revenue_pct": round(delta_revenue / previous["revenue_brl"] * 100, 2) if previous["revenue_brl"] else None
+    }
 
 def create_initial_sales(db: Session, owner: str):
     # Removendo as vendas iniciais
     pass
 
-def sync_product_to_dashboard(db: Session, product: Product, action: str = "create_or_update"):
-    db_dash_product = db.query(DashboardProduct).filter(
-        DashboardProduct.original_id == product.id,
-        DashboardProduct.owner == product.owner
-    ).first()
-    
-    if db_dash_product:
-        db_dash_product.description = product.description
-        db_dash_product.image_url = product.image_url
-        db_dash_product.current_quantity = product.quantity
-        db_dash_product.suggested_quantity = product.suggested_quantity
-        db_dash_product.price_brl = product.price_brl
-        db_dash_product.price_usd = product.price_usd
-        db_dash_product.status = product.status
-        db_dash_product.categories = product.categories
-        db_dash_product.last_update = datetime.utcnow().isoformat()
-        db_dash_product.is_active = 1 if product.quantity > 0 else 0
-    else:
-        dash_product = DashboardProduct(
-            original_id=product.id,
-            description=product.description,
-            image_url=product.image_url,
-            initial_quantity=product.quantity,
-            current_quantity=product.quantity,
-            suggested_quantity=product.suggested_quantity,
-            price_brl=product.price_brl,
-            price_usd=product.price_usd,
-            status=product.status,
-            categories=product.categories,
-            owner=product.owner,
-            is_active=1
+def product_sale_changes(product) -> dict:
+    # Campos que uma venda altera, para o delta do dashboard. `product` é a
+    # linha devolvida pelo UPDATE de decrement_stock.
+    return {
+        "original_id": product.id,
+        "sold_quantity": product.sold_quantity,
+        "current_quantity": product.quantity,
+        "status": product.status,
+        "last_update": product.last_update,
+        "is_active": product.quantity > 0
+    }
+
+def dashboard_product_response(p: Product) -> dict:
+    # Mantém o formato da antiga tabela dashboard_products (id == original_id)
+    return {
+        "id": p.id,
+        "original_id": p.id,
+        "description": p.description,
+        "image_url": p.image_url,
+        "initial_quantity": p.quantity + (p.sold_quantity or 0),
+        "sold_quantity": p.sold_quantity or 0,
+        "current_quantity": p.quantity,
+        "suggested_quantity": p.suggested_quantity,
+        "price_brl": p.price_brl,
+        "price_usd": p.price_usd,
+        "status": p.status,
+        "categories": p.categories.split(",") if p.categories else [],
+        "last_update": p.last_update,
+        "is_active": p.quantity > 0
+    }
+
+def product_delta(p) -> dict:
+    # Linha completa para os deltas de criação, edição, exclusão e importação;
+    # produtos excluídos vêm com deleted=True e devem sair do dashboard
+    return {**dashboard_product_response(p), "deleted": p.deleted_at is not None}
+
+def exchange_rate_response() -> dict:
+    snapshot = exchange_rate_service.snapshot
+    return {
+        "rate": snapshot.rate,
+        "source": snapshot.source,
+        "updated_at": snapshot.updated_at.isoformat() if snapshot.updated_at else None,
+        "age_seconds": snapshot.age_seconds
+    }
+
+def dashboard_aggregates(db: Session, owner: str) -> dict:
+    # Totais do dia e acumulados, lidos do rollup diário
+    today = datetime.utcnow().date().isoformat()
+    totals = (
+        db.query(
+            func.coalesce(func.sum(SalesDaily.quantity), 0),
+            func.coalesce(func.sum(SalesDaily.revenue_brl), 0),
+            func.coalesce(func.sum(SalesDaily.revenue_usd), 0),
+            func.coalesce(func.sum(case((SalesDaily.day == today, SalesDaily.quantity), else_=0)), 0),
+            func.coalesce(func.sum(case((SalesDaily.day == today, SalesDaily.revenue_brl), else_=0)), 0),
+            func.coalesce(func.sum(case((SalesDaily.day == today, SalesDaily.revenue_usd), else_=0)), 0)
         )
-        db.add(dash_product)
-    db.commit()
+        .filter(SalesDaily.owner == owner)
+        .one()
+    )
+    return {
+        "day": today,
+        "total": {"quantity": totals[0], "revenue_brl": totals[1], "revenue_usd": totals[2]},
+        "today": {"quantity": totals[3], "revenue_brl": totals[4], "revenue_usd": totals[5]}
+    }
 
-def update_dashboard_sale(db: Session, sale: Sale):
-    dash_product = db.query(DashboardProduct).filter(
-        DashboardProduct.original_id == sale.product_id,
-        DashboardProduct.owner == sale.owner
-    ).first()
-    
-    if dash_product:
-        dash_product.sold_quantity += sale.quantity
-        dash_product.current_quantity = dash_product.initial_quantity - dash_product.sold_quantity
-        dash_product.status = calculate_status(dash_product.current_quantity, dash_product.suggested_quantity)
-        dash_product.last_update = datetime.utcnow().isoformat()
-        dash_product.is_active = 1 if dash_product.current_quantity > 0 else 0
-        db.commit()
+def load_dashboard_aggregates(owner: str) -> dict:
+    db = SessionLocal()
+    try:
+        return dashboard_aggregates(db, owner)
+    finally:
+        db.close()
+
+def dashboard_snapshot_products(db: Session, owner: str, after_id: int = 0) -> List[dict]:
+    # Um bloco do snapshot, em ordem de id (índice parcial owner, id): a posição
+    # de um produto não muda se ele for vendido ou editado durante o envio
+    products = (
+        db.query(Product)
+        .filter(Product.owner == owner, product_available(), Product.id > after_id)
+        .order_by(Product.id)
+        .limit(WS_SNAPSHOT_CHUNK_SIZE)
+        .all()
+    )
+    return jsonable_encoder([dashboard_product_response(p) for p in products])
+
+def load_dashboard_snapshot_products(owner: str, after_id: int) -> List[dict]:
+    db = SessionLocal()
+    try:
+        return dashboard_snapshot_products(db, owner, after_id)
+    finally:
+        db.close()
+
+def dashboard_snapshot(owner: str) -> dict:
+    # Estado inicial do protocolo 2; roda fora do event loop com sessão própria.
+    # Traz o primeiro bloco de produtos; complete=False indica que o restante
+    # vem em mensagens "snapshot_products"
+    db = SessionLocal()
+    try:
+        products = dashboard_snapshot_products(db, owner)
+        return jsonable_encoder({
+            "type": "snapshot",
+            "version": DASHBOARD_PROTOCOL_VERSION,
+            "epoch": WORKER_ID,
+            "products": products,
+            "complete": len(products) < WS_SNAPSHOT_CHUNK_SIZE,
+            "aggregates": dashboard_aggregates(db, owner),
+            "exchange_rate": exchange_rate_response()
+        })
+    finally:
+        db.close()
+
+async def send_dashboard_snapshot(websocket: WebSocket, owner: str, seq: int):
+    # Envia o snapshot em blocos de WS_SNAPSHOT_CHUNK_SIZE produtos, todos com a
+    # seq do início; os deltas ficam na fila até o último bloco sair
+    snapshot = await run_db(dashboard_snapshot, owner)
+    await websocket.send_json({**snapshot, "seq": seq})
+    complete, products = snapshot["complete"], snapshot["products"]
+    while not complete:
+        products = await run_db(load_dashboard_snapshot_products, owner, products[-1]["id"])
+        complete = len(products) < WS_SNAPSHOT_CHUNK_SIZE
+        await websocket.send_json({
+            "type": "snapshot_products",
+            "version": DASHBOARD_PROTOCOL_VERSION,
+            "epoch": WORKER_ID,
+            "seq": seq,
+            "products": products,
+            "complete": complete
+        })
 
 async def broadcast_dashboard_update(username: str, message: dict):
-    if username in active_connections_ws2:
-        for connection in active_connections_ws2[username]:
-            try:
-                await connection.send_json(message)
-            except:
-                active_connections_ws2[username].remove(connection)
-                if not active_connections_ws2[username]:
-                    del active_connections_ws2[username]
+    await broadcast_bus.publish(username, message)
+
+def merge_sale_events(sales: List[dict]) -> dict:
+    # Um lote de mensagens new_sale vira uma só, com os contadores somados por produto
+    if len(sales) == 1:
+        return sales[0]
+    items = {}
+    for sale in sales:
+        for item in sale.get("items") or [sale]:
+            merged = items.setdefault(item["product_id"], {
+                "product_id": item["product_id"],
+                "product_description": item["product_description"],
+                "quantity": 0,
+                "value": 0
+            })
+            merged["quantity"] += item["quantity"]
+            merged["value"] += item["value"]
+            merged["action"] = item["action"]
+    return {
+        "product_description": f"{len(sales)} vendas de {len(items)} produto(s)",
+        "quantity": sum(i["quantity"] for i in items.values()),
+        "value": sum(i["value"] for i in items.values()),
+        "action": "batch",
+        "sales": len(sales),
+        "items": list(items.values())
+    }
+
+async def publish_sale_batch(owner: str, sales: List[dict], products: List[dict]):
+    # Uma mensagem new_sale (protocolo 1) e um delta (protocolo 2) por lote;
+    # os totais são lidos uma vez por lote
+    await broadcast_dashboard_update(owner, {"type": "new_sale", "data": merge_sale_events(sales)})
+    await broadcast_dashboard_delta(owner, {
+        "products": products,
+        "aggregates": await run_db(load_dashboard_aggregates, owner)
+    })
+
+sale_batcher.add_listener(publish_sale_batch)
+
+async def broadcast_dashboard_delta(username: Optional[str], changes: dict):
+    # Delta do protocolo 2; a sequência é atribuída por dono em cada worker.
+    # username=None: vale para todos os donos (ex.: nova cotação do dólar).
+    await broadcast_bus.publish(username, jsonable_encoder({
+        "type": "delta",
+        "version": DASHBOARD_PROTOCOL_VERSION,
+        "timestamp": datetime.utcnow().isoformat(),
+        **changes
+    }))
 
 
 # ===================== INIT DB =====================
 
 
+def ensure_columns() -> set:
+    # Idem para colunas novas (anuláveis) em tabelas que já existiam; as
+    # migrações do Alembic fazem o mesmo com guarda. Retorna (tabela, coluna)
+    # das que foram criadas agora.
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = set()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                    ))
+                    added.add((table.name, column.name))
+    return added
+
+def ensure_indexes():
+    # create_all só cria índices junto com tabelas novas; aqui cobrimos bancos existentes
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    added_columns = ensure_columns()
+    ensure_indexes()
+    init_product_search()
     
     db = SessionLocal()
     try:
-        current_dollar_rate = get_dollar_exchange_rate()
+        seed_users(db)
         owner = "user@example.com"
         create_initial_products(db, owner)
         create_initial_sales(db, owner)
-        
-        # Registrar produtos iniciais no histórico
-        products = db.query(Product).all()
-        for product in products:
-            history_entry = ProductHistory(
-                original_id=product.id,
-                description=product.description,
-                image_url=product.image_url,
-                quantity=product.quantity,
-                suggested_quantity=product.suggested_quantity,
-                price_brl=product.price_brl,
-                price_usd=product.price_usd,
-                status=product.status,
-                categories=product.categories,
-                owner=product.owner,
-                action="created",
-                action_reason="Initial setup"
-            )
-            db.add(history_entry)
+
+        # Bancos anteriores à tabela de categorias: migra as strings existentes
+        if db.query(ProductCategory.product_id).first() is None and db.query(Product.id).first() is not None:
+            backfill_product_categories(db)
+
+        # Produtos anteriores à exclusão lógica (só quando a coluna acabou de ser criada)
+        if ("products", "sold_quantity") in added_columns:
+            backfill_product_state(db)
+
+        # Histórico anterior à coluna action_month
+        db.execute(
+            update(ProductHistory)
+            .where(ProductHistory.action_month.is_(None))
+            .values(action_month=func.substr(ProductHistory.action_date, 1, 7))
+        )
         db.commit()
+
+        if HISTORY_RETENTION_MONTHS > 0:
+            purge_product_history(db, HISTORY_RETENTION_MONTHS)
+
+        # Bancos anteriores ao rollup diário: preenche a partir das vendas existentes
+        if db.query(SalesDaily.id).first() is None and db.query(Sale.id).first() is not None:
+            rebuild_sales_rollup(db)
+
+        # Bancos anteriores ao placar de produtos
+        if db.query(ProductSalesTotal.id).first() is None and db.query(Sale.id).first() is not None:
+            rebuild_product_totals(db)
     except Exception as e:
         print(f"Error initializing database: {e}")
         db.rollback()
@@ -1032,5 +3481,36 @@ init_db()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "rebuild-sales-rollup", "purge-history"])
+    parser.add_argument("--owner", help="limita o rebuild a um único dono")
+    parser.add_argument("--keep-months", type=int, default=HISTORY_RETENTION_MONTHS or 12,
+                        help="meses de histórico mantidos pelo purge-history")
+    args = parser.parse_args()
+
+    if args.command == "purge-history":
+        db = SessionLocal()
+        try:
+            rows = purge_product_history(db, args.keep_months)
+            print(f"Histórico apagado: {rows} linha(s)")
+        finally:
+            db.close()
+        sys.exit(0)
+
+    if args.command == "rebuild-sales-rollup":
+        db = SessionLocal()
+        try:
+            rows = rebuild_sales_rollup(db, args.owner)
+            print(f"Rollup diário recalculado: {rows} linha(s)")
+            rows = rebuild_product_totals(db, args.owner)
+            print(f"Placar de produtos recalculado: {rows} linha(s)")
+        finally:
+            db.close()
+        sys.exit(0)
+
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Pings do protocolo WebSocket (respondidos pelo navegador) para todas as conexões
+    uvicorn.run(
+        app, host="0.0.0.0", port=8000,
+        ws_ping_interval=WS_PING_INTERVAL_SECONDS, ws_ping_timeout=WS_PING_TIMEOUT_SECONDS
+    )
\ No newline at end of file
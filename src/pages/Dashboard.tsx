@@ -93,7 +93,9 @@ const Dashboard = () => {
     const totalQty = productsData.reduce((acc: number, product: ProductData) => acc + (product.sales || 0), 0);
     setTotalQuantity(totalQty);
     
-    const totalRev = categoryData.reduce((acc: number, cat: CategoryData) => acc + (cat.revenue || 0), 0);
+    // Faturamento pela tendência diária: em /sales-by-category/ uma venda conta
+    // em todas as categorias do produto, e a soma das categorias passa do total
+    const totalRev = trendData.reduce((acc: number, day: SaleTrendData) => acc + (day.total || 0), 0);
     setTotalSales(totalRev);
     
   } catch (error) {
@@ -107,8 +109,6 @@ const Dashboard = () => {
     if (!categories || categories.length === 0) return [];
     
     if (categories.length <= 3) {
-      const total = categories.reduce((acc, cat) => acc + (cat.revenue || 0), 0);
-      setTotalSales(total);
       return categories;
     }
 
@@ -127,8 +127,6 @@ const Dashboard = () => {
       }
     ];
 
-    setTotalSales(sorted.reduce((acc, cat) => acc + (cat.revenue || 0), 0));
-
     return result;
   };
 
@@ -145,7 +143,8 @@ const setupWebSocket = () => {
     ws.current.close();
   }
 
-  ws.current = new WebSocket(`ws://localhost:8000/dashboard-ws/?token=${token}`);
+  // heartbeat=1: o servidor envia "ping" e desconecta quem não responde "pong"
+  ws.current = new WebSocket(`ws://localhost:8000/dashboard-ws/?token=${token}&heartbeat=1`);
 
   ws.current.onopen = () => {
     console.log('WebSocket conectado');
@@ -155,6 +154,12 @@ const setupWebSocket = () => {
   ws.current.onmessage = (e) => {
     try {
       const data = JSON.parse(e.data);
+
+      if (data.type === 'ping') {
+        ws.current?.send(JSON.stringify({ type: 'pong' }));
+        return;
+      }
+
       console.log('Nova mensagem recebida:', data);
       
       if (data.type === 'new_sale') {
@@ -37,6 +37,22 @@ const HomePage: React.FC = () => {
     }
   };
 
+  // /products/ é paginado por cursor: segue o X-Next-Cursor até a última página.
+  // Retorna null se o token foi recusado.
+  const fetchAllProducts = async (headers: Record<string, string>): Promise<Product[] | null> => {
+    const allProducts: Product[] = [];
+    let cursor: string | null = null;
+    do {
+      const params = new URLSearchParams({ limit: '1000' });
+      if (cursor) params.set('cursor', cursor);
+      const response = await fetch(`http://localhost:8000/products/?${params}`, { headers });
+      if (response.status === 401) return null;
+      allProducts.push(...(await response.json()));
+      cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    return allProducts;
+  };
+
   // Obter dados da API
   const fetchData = async () => {
     try {
@@ -50,19 +66,18 @@ const HomePage: React.FC = () => {
         'Authorization': `Bearer ${token}`
       };
 
-      const [productsResponse, categoriesResponse] = await Promise.all([
-        fetch('http://localhost:8000/products/', { headers }),
+      const [productsData, categoriesResponse] = await Promise.all([
+        fetchAllProducts(headers),
         fetch('http://localhost:8000/categories/', { headers })
       ]);
 
-      if (productsResponse.status === 401 || categoriesResponse.status === 401) {
+      if (productsData === null || categoriesResponse.status === 401) {
         localStorage.removeItem('token');
         sessionStorage.removeItem('token');
         navigate('/login');
         return;
       }
 
-      const productsData = await productsResponse.json();
       const categoriesData = await categoriesResponse.json();
 
       setProducts(productsData);